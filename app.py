@@ -1,23 +1,171 @@
-from flask import Flask, current_app, request, jsonify
+from flask import Blueprint, Flask, Response, current_app, g, has_request_context, make_response, request, jsonify, send_file, stream_with_context, url_for
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import exc
+from sqlalchemy import case, create_engine, event, exc, func, insert, literal, or_, select
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import Session, joinedload, load_only, selectinload
+from contextlib import contextmanager
+from functools import lru_cache, partial, wraps
+from operator import itemgetter
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import copy
+import gzip
+import hashlib
+import json
+import multiprocessing
+import sqlite3
+import struct
+import threading
+import time
+import weakref
+import zlib
 from flask_marshmallow import Marshmallow
 from marshmallow import fields, Schema, post_dump
 from flask_cors import CORS
-from datetime import datetime, timedelta
-from werkzeug.security import generate_password_hash, check_password_hash
+from datetime import datetime, timedelta, timezone
+from werkzeug.http import http_date
+from werkzeug.local import LocalProxy
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
 import os
 import jwt
 
-app = Flask(__name__)
-CORS(app)
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
 
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config["SQLALCHEMY_DATABASE_URI"] = 'sqlite:///' + os.path.join(basedir, 'app.sqlite')
-app.config['SECRET_KEY'] = 'shaywhytee'
+default_config = {
+  'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(basedir, 'app.sqlite'),
+  'SQLALCHEMY_ENGINE_OPTIONS': {
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_timeout': 30,
+    'connect_args': {'timeout': 30},
+  },
+  'SQLITE_PRAGMAS': {
+    'auto_vacuum': 'INCREMENTAL',
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,
+    'mmap_size': 268435456,
+    'busy_timeout': 30000,
+    'temp_store': 'MEMORY',
+    'journal_size_limit': 16777216,
+  },
+  'DB_WRITE_RETRIES': 3,
+  'SECRET_KEY': 'shaywhytee',
+  'AUTH_CACHE_SIZE': 1024,
+  'AUTH_CACHE_TTL': 300,
+  'PASSWORD_HASH_METHOD': 'scrypt:32768:8:1',
+  'PASSWORD_HASH_WORKERS': 2,
+  'SLOW_REQUEST_MS': 500,
+  'RESPONSE_CACHE_SIZE': 2048,
+  'RESPONSE_CACHE_TTL': 60,
+  'CHANGE_FEED_BUFFER': 1000,
+  'CHANGE_FEED_KEEPALIVE': 15,
+  'SEARCH_PAGE_SIZE': 20,
+  'COMPRESS_MIN_SIZE': 1024,
+  'COMPRESS_GZIP_LEVEL': 6,
+  'COMPRESS_BROTLI_QUALITY': 5,
+  'JOB_WORKERS': 2,
+  'JOB_MAX_ATTEMPTS': 3,
+  'JOB_RETRY_DELAY': 30,
+  'JOB_TIMEOUT': 3600,
+  'JOB_POLL_INTERVAL': 1,
+  'JOB_RESULTS_DIR': os.path.join(basedir, 'job_results'),
+  'HISTORY_CHUNK_SAMPLES': 256,
+  'HISTORY_MAX_POINTS': 200,
+  'PURGE_BATCH_SIZE': 500,
+  'PURGE_PAUSE': 0.01,
+  'VACUUM_STEP_PAGES': 1000,
+  'SNAPSHOT_PATH': None,
+  'SNAPSHOT_MAX_AGE': 60,
+  'SYNC_PAGE_SIZE': 500,
+  'SYNC_TOMBSTONE_DAYS': 30,
+}
+
+api = Blueprint('api', __name__, cli_group=None)
+db = SQLAlchemy()
+ma = Marshmallow()
+
+def apply_sqlite_pragmas(pragmas, dbapi_connection, connection_record=None):
+  cursor = dbapi_connection.cursor()
+  for name, value in pragmas.items():
+    cursor.execute(f'PRAGMA {name} = {value}')
+  cursor.close()
+
+def configure_sqlite(pragmas, dbapi_connection, connection_record):
+  if isinstance(dbapi_connection, sqlite3.Connection):
+    apply_sqlite_pragmas(pragmas, dbapi_connection)
+
+@event.listens_for(Engine, 'handle_error')
+def flag_lock_error(context):
+  if isinstance(context.original_exception, sqlite3.OperationalError) and has_request_context():
+    message = str(context.original_exception)
+    if 'locked' in message or 'busy' in message:
+      g.db_lock_error = True
+
+def retry_on_lock(view):
+  @wraps(view)
+  def wrapper(*args, **kwargs):
+    retries = current_app.config['DB_WRITE_RETRIES']
+    for attempt in range(retries + 1):
+      g.db_lock_error = False
+      response = view(*args, **kwargs)
+      if not g.db_lock_error or attempt == retries:
+        return response
+      db.session.rollback()
+      time.sleep(0.05 * 2 ** attempt)
+  return wrapper
+
+password_pool = None
+password_pool_lock = threading.Lock()
+
+def get_password_pool():
+  global password_pool
+  with password_pool_lock:
+    if password_pool is None:
+      # Forked workers would inherit the server's client sockets and hold closed keep-alive connections open.
+      password_pool = ProcessPoolExecutor(max_workers=current_app.config['PASSWORD_HASH_WORKERS'], mp_context=multiprocessing.get_context('spawn'))
+    return password_pool
+
+# A hash worker that crashed or was OOM-killed breaks the whole pool, so it is replaced and the call retried once.
+def run_in_password_pool(fn, *args):
+  global password_pool
+  pool = get_password_pool()
+  try:
+    return pool.submit(fn, *args).result()
+  except BrokenProcessPool:
+    with password_pool_lock:
+      if password_pool is pool:
+        password_pool = None
+    return get_password_pool().submit(fn, *args).result()
+
+def hash_password(password):
+  return run_in_password_pool(generate_password_hash, password, current_app.config['PASSWORD_HASH_METHOD'])
+
+def verify_password(password_hash, password):
+  return run_in_password_pool(check_password_hash, password_hash, password)
 
-db = SQLAlchemy(app)
-ma = Marshmallow(app)
+# Werkzeug stores the full parameters ('scrypt' is saved as 'scrypt:32768:8:1'), so a short
+# configured method is expanded with its defaults before comparing.
+password_hash_defaults = {'scrypt': [str(2 ** 15), '8', '1'], 'pbkdf2': ['sha256', str(DEFAULT_PBKDF2_ITERATIONS)]}
+
+@lru_cache(maxsize=None)
+def password_hash_prefix(method):
+  name, *args = method.split(':')
+  return ':'.join([name, *args, *password_hash_defaults.get(name, [])[len(args):]])
+
+def password_needs_rehash(password_hash):
+  return password_hash.split('$', 1)[0] != password_hash_prefix(current_app.config['PASSWORD_HASH_METHOD'])
 
 class AccountInfo(db.Model):
   id = db.Column(db.Integer, primary_key=True)
@@ -33,10 +181,10 @@ class AccountInfo(db.Model):
     self.user_auth = user_auth
     
   def set_password(self, password):
-    self.user_password_hash = generate_password_hash(password)
+    self.user_password_hash = hash_password(password)
 
   def check_password(self, password):
-    return check_password_hash(self.user_password_hash, password)
+    return verify_password(self.user_password_hash, password)
     
 class RMA(db.Model):
   id = db.Column(db.Integer, primary_key=True)
@@ -45,15 +193,21 @@ class RMA(db.Model):
   bay = db.Column(db.Integer, nullable=False)
   technician_id = db.Column(db.Integer, db.ForeignKey('account_info.id'), nullable=False)
   technician = db.relationship('AccountInfo', foreign_keys=[technician_id])
-  repair_status = db.Column(db.String)
+  repair_status = db.Column(db.String, index=True)
   repair_notes = db.Column(db.String)
   repair_parts = db.Column(db.String)
   repair_completion = db.Column(db.Boolean, nullable=False, default=False)
+  created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+  version = db.Column(db.Integer, nullable=False, server_default='1', index=True)
   vac_status = db.relationship('VacStatus', back_populates='rma', uselist=False)
   freeze_status = db.relationship('FreezeStatus', back_populates='rma', uselist=False)
   heat_status = db.relationship('HeatStatus', back_populates='rma', uselist=False)
   module_status = db.relationship('ModuleStatus', back_populates='rma', uselist=False)
 
+  __table_args__ = (
+    db.Index('ix_rma_technician_id_repair_status', 'technician_id', 'repair_status'),
+  )
+
   def __init__(self, odoo_id, fd_sn, bay, technician_id, repair_status, repair_notes, repair_parts, repair_completion):
     self.odoo_id = odoo_id
     self.fd_sn = fd_sn
@@ -81,7 +235,8 @@ class VacStatus(db.Model):
   mtorr_300 = db.Column(db.Integer)
   mtorr_200 = db.Column(db.Integer)
   mtorr_bo = db.Column(db.Integer)
-  rma_id = db.Column(db.Integer, db.ForeignKey(rma_main_id))
+  rma_id = db.Column(db.Integer, db.ForeignKey(rma_main_id), index=True)
+  version = db.Column(db.Integer, nullable=False, server_default='1', index=True)
   rma = db.relationship('RMA', back_populates='vac_status')
 
   def __init__(self, pump_type, pump_sn, pump_mtorr_1000, pump_mtorr_500, pump_mtorr_300, pump_mtorr_200, pump_mtorr_bo, mtorr_1000, mtorr_500, mtorr_300, mtorr_200, mtorr_bo, rma):
@@ -106,7 +261,8 @@ class FreezeStatus(db.Model):
   temp_front = db.Column(db.Integer)
   temp_mid = db.Column(db.Integer)
   temp_back = db.Column(db.Integer)
-  rma_id = db.Column(db.Integer, db.ForeignKey(rma_main_id), nullable=False)
+  rma_id = db.Column(db.Integer, db.ForeignKey(rma_main_id), nullable=False, index=True)
+  version = db.Column(db.Integer, nullable=False, server_default='1', index=True)
   rma = db.relationship('RMA', back_populates='freeze_status')
 
   def __init__(self, coil_count, amp_reading, temp_front, temp_mid, temp_back, rma):
@@ -128,7 +284,8 @@ class HeatStatus(db.Model):
   pad_four = db.Column(db.Integer)
   pad_five = db.Column(db.Integer)
   pad_six = db.Column(db.Integer)
-  rma_id = db.Column(db.Integer, db.ForeignKey(rma_main_id), nullable=False)
+  rma_id = db.Column(db.Integer, db.ForeignKey(rma_main_id), nullable=False, index=True)
+  version = db.Column(db.Integer, nullable=False, server_default='1', index=True)
   rma = db.relationship('RMA', back_populates='heat_status')
 
   def __init__(self, ambient, heat_limit, max_temp, pad_one, pad_two, pad_three, pad_four, pad_five, pad_six, rma):
@@ -146,13 +303,66 @@ class HeatStatus(db.Model):
 class ModuleStatus(db.Model):
   id = db.Column(db.Integer, primary_key=True)
   replaced_parts = db.Column(db.String)
-  rma_id = db.Column(db.Integer, db.ForeignKey('rma.id'), nullable=False)
+  rma_id = db.Column(db.Integer, db.ForeignKey(rma_main_id), nullable=False, index=True)
+  version = db.Column(db.Integer, nullable=False, server_default='1', index=True)
   rma = db.relationship('RMA', back_populates='module_status')
 
   def __init__(self, replaced_parts, rma):
     self.replaced_parts = replaced_parts
     self.rma = rma
 
+class RMAStats(db.Model):
+  technician_id = db.Column(db.Integer, primary_key=True)
+  repair_status = db.Column(db.String, primary_key=True)
+  repair_completion = db.Column(db.Boolean, primary_key=True)
+  total = db.Column(db.Integer, nullable=False, default=0)
+
+class Job(db.Model):
+  id = db.Column(db.Integer, primary_key=True)
+  kind = db.Column(db.String, nullable=False)
+  params = db.Column(db.JSON, nullable=False, default=dict)
+  status = db.Column(db.String, nullable=False, default='queued')
+  attempts = db.Column(db.Integer, nullable=False, default=0)
+  max_attempts = db.Column(db.Integer, nullable=False)
+  result = db.Column(db.JSON)
+  result_path = db.Column(db.String)
+  error = db.Column(db.String)
+  created_by = db.Column(db.Integer, db.ForeignKey('account_info.id'))
+  created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+  run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+  locked_until = db.Column(db.DateTime)
+  started_at = db.Column(db.DateTime)
+  finished_at = db.Column(db.DateTime)
+
+  __table_args__ = (
+    db.Index('ix_job_status_run_after', 'status', 'run_after'),
+  )
+
+class ReadingHistory(db.Model):
+  id = db.Column(db.Integer, primary_key=True)
+  rma_id = db.Column(db.Integer, db.ForeignKey(rma_main_id), nullable=False)
+  block = db.Column(db.String, nullable=False)
+  started_at = db.Column(db.DateTime, nullable=False)
+  ended_at = db.Column(db.DateTime, nullable=False)
+  samples = db.Column(db.Integer, nullable=False, default=0)
+  data = db.Column(db.LargeBinary, nullable=False, default=b'')
+
+  __table_args__ = (
+    db.Index('ix_reading_history_rma_id_block_started_at', 'rma_id', 'block', 'started_at'),
+  )
+
+class SyncState(db.Model):
+  id = db.Column(db.Integer, primary_key=True)
+  version = db.Column(db.Integer, nullable=False)
+  pruned_version = db.Column(db.Integer, nullable=False)
+
+class SyncTombstone(db.Model):
+  version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+  table_name = db.Column(db.String, nullable=False)
+  row_id = db.Column(db.Integer, nullable=False)
+  technician_id = db.Column(db.Integer)
+  deleted_at = db.Column(db.DateTime, nullable=False)
+
 class AccountSchema(ma.Schema):
     class Meta:
         fields = ('id', 'user_name', 'user_email', 'user_password_hash', 'user_auth')
@@ -200,11 +410,897 @@ class RMASchema(Schema):
 rma_schema = RMASchema()
 multi_rma_schema = RMASchema(many=True)
 
+class JobSchema(Schema):
+    class Meta:
+        fields = ('id', 'kind', 'params', 'status', 'attempts', 'max_attempts', 'result', 'error', 'created_at', 'started_at', 'finished_at')
+
+job_schema = JobSchema()
+
+def compile_dumper(schema_cls, only=None):
+  names = sorted(name for name in schema_cls.Meta.fields if only is None or name in only)
+  namespace = {}
+  items = []
+  for name in names:
+    field = schema_cls._declared_fields.get(name)
+    if isinstance(field, fields.Nested):
+      namespace[f'dump_{name}'] = compile_dumper(field.nested)
+      items.append(f"{name!r}: None if obj.{name} is None else dump_{name}(obj.{name})")
+    else:
+      items.append(f"{name!r}: obj.{name}")
+  source = f"def dump(obj):\n  return {{{', '.join(items)}}}\n"
+  exec(source, namespace)
+  return namespace['dump']
+
+dump_rma = compile_dumper(RMASchema)
+
+@lru_cache(maxsize=64)
+def compiled_rma_dumper(only=None):
+  return compile_dumper(RMASchema, only)
+
+def json_response(data, status=200):
+  if current_app.debug:
+    return jsonify(data), status
+  body = json.dumps(data, sort_keys=True, separators=(',', ':'))
+  return current_app.response_class(body + '\n', status=status, mimetype='application/json')
+
+def negotiate_format(accept_mimetypes):
+  if msgpack is not None and accept_mimetypes.best_match(['application/json', 'application/x-msgpack']) == 'application/x-msgpack':
+    return 'msgpack'
+  return 'json'
+
+def negotiate_encoding(accept_encodings):
+  return accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+
+def compress_body(body, encoding):
+  if encoding == 'br':
+    return brotli.compress(body, quality=current_app.config['COMPRESS_BROTLI_QUALITY'])
+  return gzip.compress(body, compresslevel=current_app.config['COMPRESS_GZIP_LEVEL'])
+
+def compress_stream(chunks, encoding):
+  if encoding == 'br':
+    compressor = brotli.Compressor(quality=current_app.config['COMPRESS_BROTLI_QUALITY'])
+    for chunk in chunks:
+      yield compressor.process(chunk.encode())
+    yield compressor.finish()
+  else:
+    compressor = zlib.compressobj(current_app.config['COMPRESS_GZIP_LEVEL'], zlib.DEFLATED, 31)
+    for chunk in chunks:
+      yield compressor.compress(chunk.encode())
+    yield compressor.flush()
+
+def columnar(rows):
+  columns = {}
+  flat_rows = []
+  for row in rows:
+    flat = {}
+    for key, value in row.items():
+      if isinstance(value, dict):
+        for nested_key, nested_value in value.items():
+          flat[f'{key}.{nested_key}'] = nested_value
+      else:
+        flat[key] = value
+    for key in flat:
+      columns.setdefault(key, None)
+    flat_rows.append(flat)
+  return {'columns': list(columns), 'rows': [[flat.get(key) for key in columns] for flat in flat_rows]}
+
+def encode_rma_list(data, response_format):
+  if response_format == 'msgpack':
+    payload = {key: value for key, value in data.items() if key != 'data'}
+    payload.update(columnar(data['data']))
+    return msgpack.packb(payload), 'application/x-msgpack'
+  return (json.dumps(data, sort_keys=True, separators=(',', ':')) + '\n').encode(), 'application/json'
+
+def rma_list_response(data):
+  response_format = negotiate_format(request.accept_mimetypes)
+  if response_format == 'json':
+    return json_response(data)
+  body, mimetype = encode_rma_list(data, response_format)
+  return current_app.response_class(body, mimetype=mimetype)
+
+rma_relationships = ('technician', 'vac_status', 'freeze_status', 'heat_status', 'module_status')
+max_page_size = 500
+export_batch_size = 1000
+
+def rma_load_options(only=None):
+  options = [joinedload(getattr(RMA, name)) for name in rma_relationships if only is None or name in only]
+  if only is not None:
+    # The primary key keeps load_only valid when only relationships are selected.
+    columns = [RMA.id] + [getattr(RMA, name) for name in only if name not in rma_relationships and name != 'id']
+    options.append(load_only(*columns))
+  return options
+
+rma_eager_options = tuple(rma_load_options())
+rma_export_options = (joinedload(RMA.technician),) + tuple(selectinload(getattr(RMA, name)) for name in rma_relationships[1:])
+
+def parse_rma_fields(args):
+  fields_arg = args.get('fields')
+  if not fields_arg:
+    return None
+  only = tuple(sorted({name.strip() for name in fields_arg.split(',') if name.strip()}))
+  unknown = set(only) - set(RMASchema.Meta.fields)
+  if unknown:
+    raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+  return only
+
+def parse_rma_page_args(args):
+  only = parse_rma_fields(args)
+  limit = args.get('limit', type=int)
+  after = args.get('after', type=int)
+  if limit is not None and not 0 < limit <= max_page_size:
+    raise ValueError(f"limit must be between 1 and {max_page_size}")
+  return only, limit, after
+
+def rma_page_query(query, only, limit, after):
+  query = query.options(*rma_load_options(only)).order_by(RMA.id)
+  if after is not None:
+    query = query.filter(RMA.id > after)
+  if limit is not None:
+    query = query.limit(limit + 1)
+  return query
+
+def rma_page_result(rmas, only, limit):
+  next_cursor = None
+  if limit is not None and len(rmas) > limit:
+    rmas = rmas[:limit]
+    next_cursor = rmas[-1].id
+
+  dump = compiled_rma_dumper(only) if only else dump_rma
+  return {'data': [dump(rma) for rma in rmas], 'next_cursor': next_cursor}
+
+def rma_page(query):
+  only, limit, after = parse_rma_page_args(request.args)
+  rmas = rma_page_query(query, only, limit, after).all()
+  return rma_page_result(rmas, only, limit)
+
+
+#***** Database Migrations *****
+
+rma_stats_triggers = [
+  '''CREATE TRIGGER IF NOT EXISTS rma_stats_insert AFTER INSERT ON rma BEGIN
+    INSERT INTO rma_stats (technician_id, repair_status, repair_completion, total)
+    VALUES (NEW.technician_id, COALESCE(NEW.repair_status, ''), NEW.repair_completion, 1)
+    ON CONFLICT (technician_id, repair_status, repair_completion) DO UPDATE SET total = total + 1;
+  END''',
+  '''CREATE TRIGGER IF NOT EXISTS rma_stats_delete AFTER DELETE ON rma BEGIN
+    UPDATE rma_stats SET total = total - 1
+    WHERE technician_id = OLD.technician_id AND repair_status = COALESCE(OLD.repair_status, '') AND repair_completion = OLD.repair_completion;
+    DELETE FROM rma_stats WHERE total <= 0;
+  END''',
+  '''CREATE TRIGGER IF NOT EXISTS rma_stats_update AFTER UPDATE OF technician_id, repair_status, repair_completion ON rma BEGIN
+    UPDATE rma_stats SET total = total - 1
+    WHERE technician_id = OLD.technician_id AND repair_status = COALESCE(OLD.repair_status, '') AND repair_completion = OLD.repair_completion;
+    INSERT INTO rma_stats (technician_id, repair_status, repair_completion, total)
+    VALUES (NEW.technician_id, COALESCE(NEW.repair_status, ''), NEW.repair_completion, 1)
+    ON CONFLICT (technician_id, repair_status, repair_completion) DO UPDATE SET total = total + 1;
+    DELETE FROM rma_stats WHERE total <= 0;
+  END''',
+]
+
+rebuild_rma_stats_statements = [
+  'DELETE FROM rma_stats',
+  '''INSERT INTO rma_stats (technician_id, repair_status, repair_completion, total)
+    SELECT technician_id, COALESCE(repair_status, ''), repair_completion, COUNT(*) FROM rma
+    GROUP BY technician_id, COALESCE(repair_status, ''), repair_completion''',
+]
+
+rma_search_schema = [
+  '''CREATE VIRTUAL TABLE IF NOT EXISTS rma_search USING fts5(
+    fd_sn, pump_sn, repair_notes, repair_parts, replaced_parts, prefix='2 3 4'
+  )''',
+  '''CREATE TRIGGER IF NOT EXISTS rma_search_insert AFTER INSERT ON rma BEGIN
+    INSERT INTO rma_search (rowid, fd_sn, pump_sn, repair_notes, repair_parts, replaced_parts)
+    VALUES (NEW.id, NEW.fd_sn, '', NEW.repair_notes, NEW.repair_parts, '');
+  END''',
+  '''CREATE TRIGGER IF NOT EXISTS rma_search_update AFTER UPDATE OF fd_sn, repair_notes, repair_parts ON rma BEGIN
+    UPDATE rma_search SET fd_sn = NEW.fd_sn, repair_notes = NEW.repair_notes, repair_parts = NEW.repair_parts
+    WHERE rowid = NEW.id;
+  END''',
+  '''CREATE TRIGGER IF NOT EXISTS rma_search_delete AFTER DELETE ON rma BEGIN
+    DELETE FROM rma_search WHERE rowid = OLD.id;
+  END''',
+  '''CREATE TRIGGER IF NOT EXISTS rma_search_vac_insert AFTER INSERT ON vac_status BEGIN
+    UPDATE rma_search SET pump_sn = NEW.pump_sn WHERE rowid = NEW.rma_id;
+  END''',
+  '''CREATE TRIGGER IF NOT EXISTS rma_search_vac_update AFTER UPDATE OF pump_sn ON vac_status BEGIN
+    UPDATE rma_search SET pump_sn = NEW.pump_sn WHERE rowid = NEW.rma_id;
+  END''',
+  '''CREATE TRIGGER IF NOT EXISTS rma_search_module_insert AFTER INSERT ON module_status BEGIN
+    UPDATE rma_search SET replaced_parts = NEW.replaced_parts WHERE rowid = NEW.rma_id;
+  END''',
+  '''CREATE TRIGGER IF NOT EXISTS rma_search_module_update AFTER UPDATE OF replaced_parts ON module_status BEGIN
+    UPDATE rma_search SET replaced_parts = NEW.replaced_parts WHERE rowid = NEW.rma_id;
+  END''',
+]
+
+sync_tables = ('rma', 'vac_status', 'freeze_status', 'heat_status', 'module_status')
+
+# Every insert, update and delete on a synced table takes the next value of sync_state.version, so
+# rows carry the version of their last change and deletes leave a tombstone with theirs.
+def sync_triggers(table):
+  technician_id = 'OLD.technician_id' if table == 'rma' else '(SELECT technician_id FROM rma WHERE id = OLD.rma_id)'
+  return [
+    f'''CREATE TRIGGER IF NOT EXISTS {table}_sync_insert AFTER INSERT ON {table} BEGIN
+      UPDATE sync_state SET version = version + 1;
+      UPDATE {table} SET version = (SELECT version FROM sync_state) WHERE id = NEW.id;
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS {table}_sync_update AFTER UPDATE ON {table} WHEN NEW.version = OLD.version BEGIN
+      UPDATE sync_state SET version = version + 1;
+      UPDATE {table} SET version = (SELECT version FROM sync_state) WHERE id = NEW.id;
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS {table}_sync_delete AFTER DELETE ON {table} BEGIN
+      UPDATE sync_state SET version = version + 1;
+      INSERT INTO sync_tombstone (version, table_name, row_id, technician_id, deleted_at)
+        VALUES ((SELECT version FROM sync_state), '{table}', OLD.id, {technician_id}, CURRENT_TIMESTAMP);
+    END''',
+  ]
+
+sync_schema = [
+  'INSERT OR IGNORE INTO sync_state (id, version, pruned_version) VALUES (1, 1, 0)',
+  *[trigger for table in sync_tables for trigger in sync_triggers(table)],
+]
+
+rebuild_rma_search_statements = [
+  'DELETE FROM rma_search',
+  '''INSERT INTO rma_search (rowid, fd_sn, pump_sn, repair_notes, repair_parts, replaced_parts)
+    SELECT rma.id, rma.fd_sn,
+      (SELECT pump_sn FROM vac_status WHERE vac_status.rma_id = rma.id ORDER BY vac_status.id DESC LIMIT 1),
+      rma.repair_notes, rma.repair_parts,
+      (SELECT replaced_parts FROM module_status WHERE module_status.rma_id = rma.id ORDER BY module_status.id DESC LIMIT 1)
+    FROM rma''',
+]
+
+migrations = [
+  (1, [
+    'CREATE INDEX IF NOT EXISTS ix_rma_repair_status ON rma (repair_status)',
+    'CREATE INDEX IF NOT EXISTS ix_rma_technician_id_repair_status ON rma (technician_id, repair_status)',
+    'CREATE INDEX IF NOT EXISTS ix_vac_status_rma_id ON vac_status (rma_id)',
+    'CREATE INDEX IF NOT EXISTS ix_freeze_status_rma_id ON freeze_status (rma_id)',
+    'CREATE INDEX IF NOT EXISTS ix_heat_status_rma_id ON heat_status (rma_id)',
+    'CREATE INDEX IF NOT EXISTS ix_module_status_rma_id ON module_status (rma_id)',
+  ]),
+  (2, [
+    'ALTER TABLE rma ADD COLUMN created_at DATETIME',
+    'CREATE INDEX IF NOT EXISTS ix_rma_created_at ON rma (created_at)',
+  ]),
+  (3, [
+    '''CREATE TABLE IF NOT EXISTS rma_stats (
+      technician_id INTEGER NOT NULL,
+      repair_status VARCHAR NOT NULL,
+      repair_completion BOOLEAN NOT NULL,
+      total INTEGER NOT NULL,
+      PRIMARY KEY (technician_id, repair_status, repair_completion)
+    )''',
+    *rma_stats_triggers,
+    *rebuild_rma_stats_statements,
+  ]),
+  (4, [
+    *rma_search_schema,
+    *rebuild_rma_search_statements,
+  ]),
+  (5, [
+    f'DELETE FROM {table} WHERE rma_id IS NULL OR rma_id NOT IN (SELECT id FROM rma)'
+    for table in ('vac_status', 'freeze_status', 'heat_status', 'module_status')
+  ]),
+  (6, [
+    'CREATE TABLE IF NOT EXISTS sync_state (id INTEGER NOT NULL PRIMARY KEY, version INTEGER NOT NULL, pruned_version INTEGER NOT NULL)',
+    '''CREATE TABLE IF NOT EXISTS sync_tombstone (
+      version INTEGER NOT NULL PRIMARY KEY,
+      table_name VARCHAR NOT NULL,
+      row_id INTEGER NOT NULL,
+      technician_id INTEGER,
+      deleted_at DATETIME NOT NULL
+    )''',
+    *[f"ALTER TABLE {table} ADD COLUMN version INTEGER DEFAULT '1' NOT NULL" for table in sync_tables],
+    *[f'CREATE INDEX IF NOT EXISTS ix_{table}_version ON {table} (version)' for table in sync_tables],
+    *sync_schema,
+  ]),
+  # Migration 6 backfilled every existing row with version 1, and /sync pages on version, so
+  # a page boundary inside those rows lost the rest. Changes never take version 1 (the counter
+  # starts there and is bumped first), so those rows get the next counter values in id order.
+  (7, [
+    statement
+    for table in sync_tables
+    for statement in (
+      f'''UPDATE {table} SET version = numbered.version
+        FROM (SELECT id, (SELECT version FROM sync_state) + ROW_NUMBER() OVER (ORDER BY id) AS version FROM {table} WHERE version = 1) AS numbered
+        WHERE {table}.id = numbered.id''',
+      f'UPDATE sync_state SET version = MAX(version, (SELECT COALESCE(MAX(version), 0) FROM {table}))',
+    )
+  ]),
+]
+
+# pysqlite only opens a transaction before DML, so schema changes take the write lock themselves:
+# a failed step rolls back whole, and workers starting together wait for each other.
+@contextmanager
+def immediate_transaction():
+  with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+    conn.exec_driver_sql('BEGIN IMMEDIATE')
+    try:
+      yield conn
+    except BaseException:
+      conn.exec_driver_sql('ROLLBACK')
+      raise
+    conn.exec_driver_sql('COMMIT')
+
+def run_migrations():
+  with db.engine.connect() as conn:
+    version = conn.exec_driver_sql('PRAGMA user_version').scalar()
+  for target_version, statements in migrations:
+    if target_version <= version:
+      continue
+    with immediate_transaction() as conn:
+      # Another worker may have applied this step while we waited for the lock.
+      version = conn.exec_driver_sql('PRAGMA user_version').scalar()
+      if target_version > version:
+        for statement in statements:
+          conn.exec_driver_sql(statement)
+        conn.exec_driver_sql(f'PRAGMA user_version = {target_version}')
+
+@event.listens_for(db.metadata, 'after_create')
+def create_sqlite_schema_extras(target, connection, **kw):
+  for statement in rma_stats_triggers + rma_search_schema + sync_schema:
+    connection.exec_driver_sql(statement)
+
+def rebuild_rma_stats():
+  with db.engine.begin() as conn:
+    for statement in rebuild_rma_stats_statements:
+      conn.exec_driver_sql(statement)
+
+@api.cli.command('rebuild-stats')
+def rebuild_stats_command():
+  rebuild_rma_stats()
+  response_cache.clear()
+  print('RMA stats rebuilt')
+
+# auto_vacuum only takes effect on an empty database or after a full VACUUM, which locks the
+# whole database while it rewrites it, so databases created before it was in SQLITE_PRAGMAS are
+# converted on demand rather than at startup; until then purges reclaim no pages.
+def enable_incremental_vacuum():
+  with db.engine.connect() as conn:
+    if conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() == 2:
+      return False
+    conn.exec_driver_sql('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.exec_driver_sql('VACUUM')
+    return True
+
+@api.cli.command('enable-incremental-vacuum')
+def enable_incremental_vacuum_command():
+  if enable_incremental_vacuum():
+    print('Database rebuilt with auto_vacuum = INCREMENTAL')
+  else:
+    print('auto_vacuum is already INCREMENTAL')
+
+def init_db():
+  with immediate_transaction() as conn:
+    fresh = not db.inspect(conn).has_table(RMA.__tablename__)
+    db.metadata.create_all(conn)
+    if fresh:
+      conn.exec_driver_sql(f'PRAGMA user_version = {migrations[-1][0]}')
+  if not fresh:
+    run_migrations()
+
+
+#***** Authentication *****
+
+class AuthCache:
+  def __init__(self, max_size, ttl):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.entries = OrderedDict()
+    self.tokens_by_user = {}
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  def get(self, token):
+    with self.lock:
+      entry = self.entries.get(token)
+      if entry is not None and entry[1] > time.time():
+        self.entries.move_to_end(token)
+        self.hits += 1
+        return entry[0]
+      if entry is not None:
+        self._evict(token)
+      self.misses += 1
+      return None
+
+  def put(self, token, user, expires_at):
+    with self.lock:
+      self.entries[token] = (user, min(expires_at, time.time() + self.ttl))
+      self.entries.move_to_end(token)
+      self.tokens_by_user.setdefault(user['id'], set()).add(token)
+      while len(self.entries) > self.max_size:
+        self._evict(next(iter(self.entries)))
+
+  def invalidate_user(self, user_id):
+    with self.lock:
+      for token in list(self.tokens_by_user.get(user_id, ())):
+        self._evict(token)
+
+  def stats(self):
+    with self.lock:
+      return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+  def _evict(self, token):
+    user, _ = self.entries.pop(token)
+    tokens = self.tokens_by_user.get(user['id'])
+    if tokens is not None:
+      tokens.discard(token)
+      if not tokens:
+        del self.tokens_by_user[user['id']]
+
+# Each app built by create_app() gets its own caches, so isolated instances never see each other's entries.
+auth_cache = LocalProxy(lambda: current_app.extensions['auth_cache'])
+
+@db.event.listens_for(AccountInfo, 'after_update')
+@db.event.listens_for(AccountInfo, 'after_delete')
+def invalidate_cached_account(mapper, connection, account):
+  auth_cache.invalidate_user(account.id)
+
+def authenticate(token):
+  user = auth_cache.get(token)
+  if user is not None:
+    return user
+
+  payload = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
+  account = db.session.get(AccountInfo, payload['user_id'])
+  return cache_account(token, payload, account)
+
+def cache_account(token, payload, account):
+  if not account:
+    return None
+
+  user = {'id': account.id, 'user_name': account.user_name, 'user_auth': account.user_auth}
+  auth_cache.put(token, user, payload['exp'])
+  return user
+
+# The browser EventSource API cannot set headers, so the change stream also takes the token
+# from an access_token query parameter or cookie.
+def stream_token(args, cookies):
+  return args.get('access_token') or cookies.get('access_token')
+
+def token_required(view, allow_stream_token=False):
+  @wraps(view)
+  def wrapper(*args, **kwargs):
+    auth_header = request.headers.get('Authorization', '')
+    if auth_header.startswith('Bearer '):
+      token = auth_header[len('Bearer '):]
+    else:
+      token = stream_token(request.args, request.cookies) if allow_stream_token else None
+    if not token:
+      return jsonify({'error': 'Authorization token is required'}), 401
+
+    try:
+      user = authenticate(token)
+    except jwt.ExpiredSignatureError:
+      return jsonify({'error': 'Token has expired'}), 401
+    except (jwt.InvalidTokenError, KeyError):
+      return jsonify({'error': 'Invalid token'}), 401
+
+    if user is None:
+      return jsonify({'error': 'Invalid token'}), 401
+
+    g.current_user = user
+    return view(*args, **kwargs)
+  return wrapper
+
+stream_token_required = partial(token_required, allow_stream_token=True)
+
+
+#***** Metrics *****
+
+class Histogram:
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * len(buckets)
+    self.total = 0
+    self.count = 0
+
+  def observe(self, value):
+    for index, bound in enumerate(self.buckets):
+      if value <= bound:
+        self.counts[index] += 1
+        break
+    self.total += value
+    self.count += 1
+
+metric_buckets = {
+  'http_request_duration_seconds': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+  'http_request_db_statements': (1, 2, 5, 10, 20, 50, 100, 500),
+  'http_request_db_seconds': (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+  'http_response_size_bytes': (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216),
+}
+request_metrics = {}
+request_metrics_lock = threading.Lock()
+
+def observe_request(endpoint, values):
+  with request_metrics_lock:
+    for name, value in values.items():
+      histogram = request_metrics.get((name, endpoint))
+      if histogram is None:
+        histogram = request_metrics[(name, endpoint)] = Histogram(metric_buckets[name])
+      histogram.observe(value)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+  if has_request_context() and 'sql_statements' in g:
+    g.sql_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+  if has_request_context() and 'sql_statements' in g:
+    g.sql_time += time.perf_counter() - g.sql_started
+    g.sql_statements.append(statement)
+
+@api.before_app_request
+def start_request_metrics():
+  g.request_started = time.perf_counter()
+  g.sql_statements = []
+  g.sql_time = 0.0
+
+@api.after_app_request
+def record_request_metrics(response):
+  if 'request_started' not in g:
+    return response
+
+  elapsed = time.perf_counter() - g.request_started
+  endpoint = request.endpoint or 'unmatched'
+  values = {
+    'http_request_duration_seconds': elapsed,
+    'http_request_db_statements': len(g.sql_statements),
+    'http_request_db_seconds': g.sql_time,
+  }
+  if not response.is_streamed:
+    values['http_response_size_bytes'] = response.calculate_content_length() or 0
+  observe_request(endpoint, values)
+
+  if elapsed * 1000 > current_app.config['SLOW_REQUEST_MS']:
+    current_app.logger.warning(
+      'Slow request %s %s (%s) took %.1f ms with %d statements:\n%s',
+      request.method, request.path, endpoint, elapsed * 1000, len(g.sql_statements), '\n'.join(g.sql_statements)
+    )
+  return response
+
+def format_metrics():
+  lines = []
+  with request_metrics_lock:
+    for name in metric_buckets:
+      lines.append(f'# TYPE {name} histogram')
+      for (metric_name, endpoint), histogram in sorted(request_metrics.items()):
+        if metric_name != name:
+          continue
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+          cumulative += count
+          lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {histogram.count}')
+        lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {histogram.total}')
+        lines.append(f'{name}_count{{endpoint="{endpoint}"}} {histogram.count}')
+  return lines
+
+@api.route('/metrics', methods=['GET'])
+def metrics():
+  lines = format_metrics()
+  auth_stats = auth_cache.stats()
+  lines.append('# TYPE auth_cache_hits_total counter')
+  lines.append(f"auth_cache_hits_total {auth_stats['hits']}")
+  lines.append('# TYPE auth_cache_misses_total counter')
+  lines.append(f"auth_cache_misses_total {auth_stats['misses']}")
+  return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+#***** Response Cache *****
+
+# Tags invalidate entries within one process. Writes made by other workers, job processes or
+# the CLI are caught by the stamp: every entry remembers sync_state.version from before it was
+# built, and a hit is only served while that counter is unchanged. The TTL bounds how long
+# changes the counter does not see (account renames in the nested technician) can stay cached.
+class ResponseCache:
+  def __init__(self, max_size, ttl):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.entries = OrderedDict()
+    self.keys_by_tag = {}
+    self.generation = 0
+    self.lock = threading.Lock()
+
+  def get(self, key, stamp):
+    with self.lock:
+      cached = self.entries.get(key)
+      if cached is None:
+        return None
+      entry_stamp, expires_at, entry = cached
+      if entry_stamp != stamp or expires_at <= time.monotonic():
+        del self.entries[key]
+        return None
+      self.entries.move_to_end(key)
+      return entry
+
+  def put(self, key, entry, tags, generation, stamp):
+    with self.lock:
+      if generation != self.generation:
+        return
+      self.entries[key] = (stamp, time.monotonic() + self.ttl, entry)
+      self.entries.move_to_end(key)
+      for tag in tags:
+        self.keys_by_tag.setdefault(tag, set()).add(key)
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+
+  def invalidate(self, *tags):
+    with self.lock:
+      self.generation += 1
+      for tag in tags:
+        for key in self.keys_by_tag.pop(tag, ()):
+          self.entries.pop(key, None)
+
+  def clear(self):
+    with self.lock:
+      self.generation += 1
+      self.entries.clear()
+      self.keys_by_tag.clear()
+
+response_cache = LocalProxy(lambda: current_app.extensions['response_cache'])
+
+# Reading the stamp through the session costs a pool checkout per cache hit, so each process
+# keeps one read-only connection for it. Outside a transaction every read sees the latest commit.
+class CacheStamp:
+  def __init__(self, path):
+    self.path = path
+    self.connection = None
+    self.pid = None
+    self.lock = threading.Lock()
+
+  def read(self):
+    # An in-memory database lives in one process, so there are no other writers to detect.
+    if self.path is None:
+      return None
+    with self.lock:
+      if self.connection is None or self.pid != os.getpid():
+        self.connection = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+        self.pid = os.getpid()
+      return self.connection.execute('SELECT version FROM sync_state WHERE id = 1').fetchall()[0][0]
+
+cache_stamp = LocalProxy(lambda: current_app.extensions['cache_stamp'])
+
+def invalidate_rma_cache(rma_id=None, technician_id=None):
+  tags = ['rmas']
+  if rma_id is not None:
+    tags.append(f'rma:{rma_id}')
+  if technician_id is not None:
+    tags.append(f'technician:{technician_id}')
+  response_cache.invalidate(*tags)
+
+def cache_entry(body, mimetype):
+  return (body, hashlib.md5(body).hexdigest(), mimetype, {})
+
+def cached_representation(entry, encoding):
+  body, etag, mimetype, encoded = entry
+  if encoding is None or len(body) < current_app.config['COMPRESS_MIN_SIZE']:
+    return body, etag, mimetype, None
+  compressed = encoded.get(encoding)
+  if compressed is None:
+    compressed = encoded[encoding] = compress_body(body, encoding)
+  return compressed, etag, mimetype, encoding
+
+def cached(*tag_formats):
+  def decorator(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+      key = f'{negotiate_format(request.accept_mimetypes)}:{request.full_path}'
+      stamp = cache_stamp.read()
+      entry = response_cache.get(key, stamp)
+      if entry is None:
+        generation = response_cache.generation
+        response = make_response(view(*args, **kwargs))
+        if response.status_code != 200 or response.is_streamed:
+          return response
+        entry = cache_entry(response.get_data(), response.mimetype)
+        response_cache.put(key, entry, [tag.format(**kwargs) for tag in tag_formats], generation, stamp)
+
+      body, etag, mimetype, encoding = cached_representation(entry, negotiate_encoding(request.accept_encodings))
+      if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+      else:
+        response = Response(body, mimetype=mimetype)
+        if encoding:
+          response.headers['Content-Encoding'] = encoding
+      response.set_etag(etag, weak=encoding is not None)
+      response.vary.add('Accept')
+      response.vary.add('Accept-Encoding')
+      return response
+    return wrapper
+  return decorator
+
+
+#***** Change Feed *****
+
+def wake_waiter(future):
+  if not future.done():
+    future.set_result(None)
+
+# Threads block in wait(); asyncio subscribers (asgi.py) await wait_async() and are woken from
+# whichever thread publishes.
+class ChangeFeed:
+  def __init__(self, buffer_size):
+    self.events = deque(maxlen=buffer_size)
+    self.last_id = 0
+    self.condition = threading.Condition()
+    self.waiters = set()
+
+  def publish(self, change, rma_id, block, changed_fields=()):
+    with self.condition:
+      self.last_id += 1
+      event = {'type': change, 'rma_id': rma_id, 'block': block, 'fields': list(changed_fields)}
+      self.events.append((self.last_id, event))
+      self.condition.notify_all()
+      waiters = list(self.waiters)
+    for loop, future in waiters:
+      loop.call_soon_threadsafe(wake_waiter, future)
+
+  def can_resume(self, after_id):
+    with self.condition:
+      oldest_id = self.events[0][0] if self.events else self.last_id + 1
+      return oldest_id - 1 <= after_id <= self.last_id
+
+  def resume_point(self, last_event_id):
+    after_id = self.last_id
+    if last_event_id is None:
+      return after_id, False
+    if self.can_resume(last_event_id):
+      return last_event_id, False
+    return after_id, True
+
+  def events_after(self, after_id):
+    with self.condition:
+      return [(event_id, event) for event_id, event in self.events if event_id > after_id]
+
+  def wait(self, after_id, timeout):
+    with self.condition:
+      if self.last_id <= after_id:
+        self.condition.wait(timeout)
+    return self.events_after(after_id)
+
+  async def wait_async(self, after_id, timeout):
+    loop = asyncio.get_running_loop()
+    waiter = (loop, loop.create_future())
+    with self.condition:
+      if self.last_id <= after_id:
+        self.waiters.add(waiter)
+      else:
+        waiter[1].set_result(None)
+    try:
+      await asyncio.wait_for(waiter[1], timeout)
+    except asyncio.TimeoutError:
+      pass
+    finally:
+      with self.condition:
+        self.waiters.discard(waiter)
+    return self.events_after(after_id)
+
+change_feed = LocalProxy(lambda: current_app.extensions['change_feed'])
+
+def format_sse(event_id, event_name, data):
+  return f'id: {event_id}\nevent: {event_name}\ndata: {json.dumps(data)}\n\n'
+
+
+#***** Report Snapshot *****
+
+read_only_pragmas = ('cache_size', 'mmap_size', 'busy_timeout', 'temp_store')
+
+# With SNAPSHOT_PATH set, report and list endpoints read a copy of the database made with
+# SQLite's online backup API instead of scanning the file the bench writes go to.
+class ReportSnapshot:
+  def __init__(self, path, engine_options, pragmas):
+    self.path = path
+    self.engine = create_engine(f'sqlite:///file:{path}?mode=ro&uri=true', **engine_options)
+    self.inode = None
+    self.refresh_requested_at = 0
+    self.lock = threading.Lock()
+    event.listen(self.engine, 'do_connect', self.record_inode)
+    event.listen(self.engine, 'connect', partial(configure_sqlite, {name: value for name, value in pragmas.items() if name in read_only_pragmas}))
+    event.listen(self.engine, 'checkout', self.check_inode)
+
+  def stat(self):
+    try:
+      return os.stat(self.path)
+    except FileNotFoundError:
+      return None
+
+  def record_inode(self, dialect, connection_record, cargs, cparams):
+    stat = self.stat()
+    connection_record.info['inode'] = stat and stat.st_ino
+
+  # A refresh replaces the file, so pooled connections still reading the old copy are reopened.
+  def check_inode(self, dbapi_connection, connection_record, connection_proxy):
+    stat = self.stat()
+    if stat is None or connection_record.info.get('inode') != stat.st_ino:
+      raise exc.DisconnectionError('Report snapshot was replaced')
+
+  def taken_at(self):
+    stat = self.stat()
+    if stat is None:
+      return None, False
+    with self.lock:
+      replaced = stat.st_ino != self.inode
+      self.inode = stat.st_ino
+    return stat.st_mtime, replaced
+
+  def refresh(self, source_engine):
+    temp_path = f'{self.path}.{os.getpid()}.tmp'
+    started = time.time()
+    target = sqlite3.connect(temp_path)
+    try:
+      with source_engine.connect() as conn:
+        conn.connection.driver_connection.backup(target)
+      target.execute('PRAGMA journal_mode = DELETE')
+    finally:
+      target.close()
+    os.utime(temp_path, (started, started))
+    os.replace(temp_path, self.path)
+    return os.path.getsize(self.path)
+
+def schedule_snapshot_refresh(snapshot):
+  now = time.time()
+  with snapshot.lock:
+    if now - snapshot.refresh_requested_at < current_app.config['SNAPSHOT_MAX_AGE']:
+      return
+    snapshot.refresh_requested_at = now
+  pending = db.session.scalar(
+    db.select(Job.id).where(Job.kind == 'refresh_snapshot', Job.status.in_(('queued', 'running'))).limit(1)
+  )
+  if pending is None:
+    db.session.add(Job(kind='refresh_snapshot', params={}, max_attempts=1))
+    db.session.commit()
+  job_runner.notify()
+
+def report_session():
+  if 'report_session' not in g:
+    snapshot = current_app.extensions.get('report_snapshot')
+    taken_at = None
+    if snapshot is not None:
+      taken_at, replaced = snapshot.taken_at()
+      if replaced:
+        response_cache.invalidate('rmas')
+    g.report_snapshot_taken_at = taken_at
+    g.report_session = db.session if taken_at is None else Session(snapshot.engine)
+  return g.report_session
+
+def close_report_session(exception=None):
+  session = g.pop('report_session', None)
+  if session is not None and session is not db.session:
+    session.close()
+
+def from_snapshot(view):
+  @wraps(view)
+  def wrapper(*args, **kwargs):
+    report_session()
+    taken_at = g.report_snapshot_taken_at
+    snapshot = current_app.extensions.get('report_snapshot')
+    if snapshot is not None and (taken_at is None or time.time() - taken_at > current_app.config['SNAPSHOT_MAX_AGE']):
+      schedule_snapshot_refresh(snapshot)
+
+    response = make_response(view(*args, **kwargs))
+    if taken_at is not None:
+      response.headers['X-Snapshot-Age'] = str(int(time.time() - taken_at))
+      response.headers['X-Snapshot-Taken-At'] = http_date(taken_at)
+    return response
+  return wrapper
+
+@api.cli.command('refresh-snapshot')
+def refresh_snapshot_command():
+  snapshot = current_app.extensions.get('report_snapshot')
+  if snapshot is None:
+    raise SystemExit('SNAPSHOT_PATH is not configured')
+  print(f'Copied {snapshot.refresh(db.engine)} bytes to {snapshot.path}')
+
 
 #***** Account Endpoints *****
 
     #Create
-@app.route('/account/create', methods=["POST"])
+@api.route('/account/create', methods=["POST"])
+@retry_on_lock
 def account_create():
   if request.content_type != 'application/json':
     return jsonify({"Error: JSONIFY"}), 400
@@ -225,7 +1321,7 @@ def account_create():
   if user_auth == None:
     user_auth = 0
   try:
-    hashed_password = generate_password_hash(user_password_hash)
+    hashed_password = hash_password(user_password_hash)
     new_account = AccountInfo(user_name, user_email, hashed_password, user_auth)
     db.session.add(new_account)
     db.session.commit()
@@ -235,7 +1331,7 @@ def account_create():
     return jsonify({'Error': 'Email already exists.'}), 400
   
     #Login
-@app.route('/login', methods=["POST"])
+@api.route('/login', methods=["POST"])
 def login():
     if request.content_type != 'application/json':
         return jsonify({"error": "Invalid content type. Expected JSON"}), 400
@@ -250,6 +1346,10 @@ def login():
     if not user.check_password(password):
         return jsonify({'error': 'Invalid password'}), 401
 
+    if password_needs_rehash(user.user_password_hash):
+        user.set_password(password)
+        db.session.commit()
+
     expiration = datetime.utcnow() + timedelta(days=1)
     token_payload = {
        'user_id' : user.id,
@@ -261,7 +1361,7 @@ def login():
     return jsonify({'id': user.id, 'token':jwt_token,'message': 'Login successful'}), 200
 
     #Get Account
-@app.route('/accounts', methods=["GET"])
+@api.route('/accounts', methods=["GET"])
 def get_accounts():
     all_accounts = db.session.query(AccountInfo).all()
     data = {
@@ -269,7 +1369,7 @@ def get_accounts():
     }
     return jsonify(data)
 
-@app.route('/account/<id>', methods=["GET"])
+@api.route('/account/<id>', methods=["GET"])
 def get_account(id):
     account = db.session.query(AccountInfo).get(id)
     if not account:
@@ -282,7 +1382,46 @@ def get_account(id):
 
 #*****RMA Endpoint*****
 
-@app.route('/<id>/create_rma', methods=["POST"])
+default_vac_status = {
+  "pump_type": "",
+  "pump_sn": "",
+  "pump_mtorr_1000": 0,
+  "pump_mtorr_500": 0,
+  "pump_mtorr_300": 0,
+  "pump_mtorr_200": 0,
+  "pump_mtorr_bo": 0,
+  "mtorr_1000": 0,
+  "mtorr_500": 0,
+  "mtorr_300": 0,
+  "mtorr_200": 0,
+  "mtorr_bo": 0
+}
+
+default_freeze_status = {
+  "coil_count": "",
+  "amp_reading": 0,
+  "temp_front": 0,
+  "temp_mid": 0,
+  "temp_back": 0
+}
+
+default_heat_status = {
+  "ambient": "",
+  "heat_limit": 0,
+  "max_temp": 0,
+  "pad_one": 0,
+  "pad_two": 0,
+  "pad_three": 0,
+  "pad_four": 0,
+  "pad_five": 0,
+  "pad_six": 0
+}
+
+default_module_status = {"replaced_parts": ""}
+
+@api.route('/<id>/create_rma', methods=["POST"])
+@token_required
+@retry_on_lock
 def rma_create(id):
     if request.content_type != 'application/json':
         return jsonify({"error": "Invalid content type. Expected JSON"}), 400
@@ -305,50 +1444,23 @@ def rma_create(id):
     try:
         rma = create_rma(odoo_id, fd_sn, bay, technician.id, repair_status, repair_notes, repair_parts, repair_completion)
 
-        vac_status_data = data.get('vac_status', {
-          "pump_type": "",
-          "pump_sn": "",
-          "pump_mtorr_1000": 0,
-          "pump_mtorr_500": 0,
-          "pump_mtorr_300": 0,
-          "pump_mtorr_200": 0,
-          "pump_mtorr_bo": 0,
-          "mtorr_1000": 0,
-          "mtorr_500": 0,
-          "mtorr_300": 0,
-          "mtorr_200": 0,
-          "mtorr_bo": 0
-        })
+        vac_status_data = data.get('vac_status', default_vac_status)
         create_status(VacStatus, rma, vac_status_data)
 
-        freeze_status_data = data.get('freeze_status', {
-          "coil_count": "",
-          "amp_reading": 0,
-          "temp_front": 0,
-          "temp_mid": 0,
-          "temp_back": 0
-        })
+        freeze_status_data = data.get('freeze_status', default_freeze_status)
         create_status(FreezeStatus, rma, freeze_status_data)
 
-        heat_status_data = data.get('heat_status', {
-          "ambient": "",
-          "heat_limit": 0,
-          "max_temp": 0,
-          "pad_one": 0,
-          "pad_two": 0,
-          "pad_three": 0,
-          "pad_four": 0,
-          "pad_five": 0,
-          "pad_six": 0
-        })
+        heat_status_data = data.get('heat_status', default_heat_status)
         create_status(HeatStatus, rma, heat_status_data)
 
-        module_status_data = data.get('module_status', {"replaced_parts":""})
+        module_status_data = data.get('module_status', default_module_status)
         create_status(ModuleStatus, rma, module_status_data)
 
         db.session.commit()
+        invalidate_rma_cache(rma.id, technician.id)
+        change_feed.publish('created', rma.id, 'rma')
 
-        serialized_rma = rma_schema.dump(rma)
+        serialized_rma = dump_rma(rma)
 
         return jsonify({'success': 'RMA created successfully', 'data': serialized_rma})
     except ValueError as ve:
@@ -366,50 +1478,228 @@ def create_rma(odoo_id, fd_sn, bay, technician_id, repair_status, repair_notes,
 def create_status(status_model, rma, status_data):
     status = status_model(rma=rma, **status_data)
     db.session.add(status)
+
+status_blocks = (
+    ('vac_status', VacStatus, default_vac_status),
+    ('freeze_status', FreezeStatus, default_freeze_status),
+    ('heat_status', HeatStatus, default_heat_status),
+    ('module_status', ModuleStatus, default_module_status),
+)
+max_bulk_rmas = 1000
+
+def status_columns(status_model):
+    return [name for name in status_model.__table__.columns.keys() if name not in ('id', 'rma_id', 'version')]
+
+column_type_names = {int: 'an integer', str: 'a string', bool: 'true or false'}
+
+def column_type_error(model, data):
+    for key, value in data.items():
+        column = model.__table__.c[key]
+        if value is None and column.nullable:
+            continue
+        expected = column.type.python_type
+        if not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+            return f'{key} must be {column_type_names[expected]}'
+    return None
+
+def validate_bulk_rma(item, seen_odoo_ids):
+    if not isinstance(item, dict):
+        return 'RMA payload must be an object'
+    for key in ('odoo_id', 'fd_sn', 'bay'):
+        if item.get(key) is None:
+            return f'{key} is required'
+    error = column_type_error(RMA, {key: item[key] for key in rma_editable_fields if key in item})
+    if error:
+        return error
+    if item['odoo_id'] in seen_odoo_ids:
+        return f"Duplicate odoo_id {item['odoo_id']}"
+    for block, status_model, _ in status_blocks:
+        status_data = item.get(block, {})
+        if not isinstance(status_data, dict):
+            return f'{block} must be an object'
+        unknown = set(status_data) - set(status_columns(status_model))
+        if unknown:
+            return f"Unknown {block} fields: {', '.join(sorted(unknown))}"
+        error = column_type_error(status_model, status_data)
+        if error:
+            return f'{block}.{error}'
+    return None
+
+@api.route('/<id>/create_rmas', methods=["POST"])
+@token_required
+@retry_on_lock
+def rma_bulk_create(id):
+    if request.content_type != 'application/json':
+        return jsonify({"error": "Invalid content type. Expected JSON"}), 400
+
+    data = request.get_json(silent=True)
+    if isinstance(data, list):
+        items = data
+    elif isinstance(data, dict):
+        items = data.get('rmas')
+    else:
+        return jsonify({"error": "Expected a list of RMAs or an object with an rmas list"}), 400
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "rmas must be a non-empty list"}), 400
+    if len(items) > max_bulk_rmas:
+        return jsonify({"error": f"At most {max_bulk_rmas} RMAs can be created per request"}), 400
+
+    technician = db.session.get(AccountInfo, id)
+
+    if not technician:
+        return jsonify({"error": f"Account with ID {id} not found"}), 404
+
+    requested_ids = [item.get('odoo_id') for item in items if isinstance(item, dict) and isinstance(item.get('odoo_id'), int)]
+    existing_ids = set(db.session.scalars(db.select(RMA.odoo_id).where(RMA.odoo_id.in_(requested_ids))))
+
+    errors = []
+    valid_items = []
+    for index, item in enumerate(items):
+        error = validate_bulk_rma(item, existing_ids)
+        if error:
+            errors.append({'index': index, 'odoo_id': item.get('odoo_id') if isinstance(item, dict) else None, 'error': error})
+            continue
+        existing_ids.add(item['odoo_id'])
+        valid_items.append(item)
+
+    if not valid_items:
+        return jsonify({"error": "Could not create RMAs.", 'errors': errors}), 400
+
+    try:
+        rma_rows = [{
+            'odoo_id': item['odoo_id'],
+            'fd_sn': item['fd_sn'],
+            'bay': item['bay'],
+            'technician_id': technician.id,
+            'repair_status': item.get('repair_status', ''),
+            'repair_notes': item.get('repair_notes', ''),
+            'repair_parts': item.get('repair_parts', ''),
+            'repair_completion': item.get('repair_completion', False),
+        } for item in valid_items]
+        rma_ids = db.session.scalars(insert(RMA).returning(RMA.id, sort_by_parameter_order=True), rma_rows).all()
+
+        for block, status_model, default_data in status_blocks:
+            columns = status_columns(status_model)
+            status_rows = []
+            for rma_id, item in zip(rma_ids, valid_items):
+                status_data = {**default_data, **item.get(block, {})}
+                row = {column: status_data.get(column) for column in columns}
+                row['rma_id'] = rma_id
+                status_rows.append(row)
+            db.session.execute(insert(status_model), status_rows)
+
+        db.session.commit()
+        invalidate_rma_cache(technician_id=technician.id)
+        for rma_id in rma_ids:
+            change_feed.publish('created', rma_id, 'rma')
+
+        created = [{'id': rma_id, 'odoo_id': item['odoo_id']} for rma_id, item in zip(rma_ids, valid_items)]
+        return jsonify({'success': f'{len(created)} RMAs created successfully', 'data': created, 'errors': errors})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": f"Could not create RMAs. {str(e)}"}), 500
   
     #Delete All
-@app.route('/rma/delete_all', methods=['DELETE'])
+@api.route('/rma/delete_all', methods=['DELETE'])
+@token_required
+@retry_on_lock
 def delete_all_rmas():
   try:
-    db.session.query(RMA).delete()
-    db.session.commit()
+    purge_rmas([])
+    response_cache.clear()
+    change_feed.publish('deleted_all', None, 'rma')
+    reclaim_free_pages()
 
     return jsonify({'success': 'All RMAs deleted successfully'})
   except Exception as e:
     db.session.rollback()
+    response_cache.clear()
     return jsonify({'error': f'Failed to delete all RMAs. {str(e)}'}), 500
   finally:
     db.session.close()
       #Get
-@app.route('/account/<technician_id>/rmas', methods=['GET'])
+@api.route('/account/<technician_id>/rmas', methods=['GET'])
+@token_required
+@cached('technician:{technician_id}')
 def get_technician_rmas(technician_id):
   try:
-    rmas = RMA.query.filter_by(technician_id=technician_id).all()
+    rmas = RMA.query.options(*rma_eager_options).filter_by(technician_id=technician_id).all()
 
-    serialized_rmas = multi_rma_schema.dump(rmas)
+    serialized_rmas = [dump_rma(rma) for rma in rmas]
 
-    return jsonify({'data': serialized_rmas})
+    return rma_list_response({'data': serialized_rmas})
   except Exception as e:
     return jsonify({'error': f'Failed to retrieve RMAs. {str(e)}'}), 500
 
-@app.route('/manager/rmas', methods=['GET'])
+@api.route('/manager/rmas', methods=['GET'])
+@token_required
+@from_snapshot
+@cached('rmas')
 def get_all_rmas():
   try:
-    all_rmas = RMA.query.all()
-
-    serialized_rmas = multi_rma_schema.dump(all_rmas)
-
-    return jsonify({'data': serialized_rmas})
+    return rma_list_response(rma_page(report_session().query(RMA)))
+  except ValueError as ve:
+    return jsonify({'error': f'Failed to retrieve RMAs. {str(ve)}'}), 400
   except Exception as e:
     return jsonify({'error': f'Failed to retrieve RMAs. {str(e)}'}), 500
   
-@app.route('/rmas', methods=['GET'])
+def rma_export_lines():
+  query = db.select(RMA).options(*rma_export_options).order_by(RMA.id).execution_options(yield_per=export_batch_size)
+  for rma in report_session().scalars(query):
+    yield json.dumps(dump_rma(rma), sort_keys=True) + '\n'
+
+@api.route('/manager/rmas/export', methods=['GET'])
+@token_required
+@from_snapshot
+def export_rmas():
+  encoding = negotiate_encoding(request.accept_encodings)
+  if encoding is None:
+    return Response(stream_with_context(rma_export_lines()), mimetype='application/x-ndjson')
+
+  response = Response(stream_with_context(compress_stream(rma_export_lines(), encoding)), mimetype='application/x-ndjson')
+  response.headers['Content-Encoding'] = encoding
+  response.vary.add('Accept-Encoding')
+  return response
+
+# Under WSGI every subscriber holds a worker thread for as long as it stays connected; asgi.py
+# serves this route natively, where an idle subscriber is a suspended coroutine.
+@api.route('/rma/events', methods=['GET'])
+@stream_token_required
+def rma_events():
+  last_event_id = request.headers.get('Last-Event-ID', type=int)
+  keepalive = current_app.config['CHANGE_FEED_KEEPALIVE']
+  # The generator runs after the app context is gone, so it keeps the feed itself, not the proxy.
+  feed = change_feed._get_current_object()
+
+  def generate():
+    after_id, reset = feed.resume_point(last_event_id)
+    if reset:
+      yield format_sse(after_id, 'reset', {'last_id': after_id})
+
+    while True:
+      events = feed.wait(after_id, keepalive)
+      if not events:
+        yield ': keep-alive\n\n'
+        continue
+      for event_id, change in events:
+        yield format_sse(event_id, 'rma_change', change)
+        after_id = event_id
+
+  response = Response(generate(), mimetype='text/event-stream')
+  response.headers['Cache-Control'] = 'no-cache'
+  response.headers['X-Accel-Buffering'] = 'no'
+  return response
+
+@api.route('/rmas', methods=['GET'])
+@token_required
+@from_snapshot
+@cached('rmas')
 def get_specific_rmas():
     try:
         odoo_id = request.args.get('odoo_id')
         repair_status = request.args.get('repair_status')
 
-        query = RMA.query
+        query = report_session().query(RMA)
 
         if odoo_id:
             query = query.filter_by(odoo_id=odoo_id)
@@ -417,25 +1707,109 @@ def get_specific_rmas():
         if repair_status:
             query = query.filter_by(repair_status=repair_status)
 
-        specific_rmas = query.all()
-
-        serialized_rmas = multi_rma_schema.dump(specific_rmas)
-
-        return jsonify({'data': serialized_rmas})
+        return rma_list_response(rma_page(query))
+    except ValueError as ve:
+        return jsonify({'error': f'Failed to retrieve RMAs. {str(ve)}'}), 400
     except Exception as e:
         return jsonify({'error': f'Failed to retrieve RMAs. {str(e)}'}), 500
     
-@app.route('/rma/<id>', methods=["GET"])
+@api.route('/rma/<id>', methods=["GET"])
+@token_required
+@cached('rma:{id}')
 def get_rma(id):
-    rma = db.session.query(RMA).get(id)
+    rma = db.session.get(RMA, id, options=rma_eager_options)
     if not rma:
         return jsonify({"Error: RMA not found"}), 404
-    data = rma_schema.dump(rma)
-    return jsonify(data)
+    data = dump_rma(rma)
+    return json_response(data)
     
+rma_editable_fields = ('odoo_id', 'fd_sn', 'bay', 'repair_status', 'repair_notes', 'repair_parts', 'repair_completion')
+
+def apply_changes(target, changes):
+    changed = []
+    for key, value in changes.items():
+        if getattr(target, key) != value:
+            setattr(target, key, value)
+            changed.append(key)
+    return changed
+
+@api.route('/rma/<id>', methods=["PATCH"])
+@token_required
+@retry_on_lock
+def patch_rma(id):
+    if request.content_type != 'application/json':
+        return jsonify({"error": "Invalid content type. Expected JSON"}), 400
+
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
+
+    block_names = [block for block, _, _ in status_blocks]
+    unknown = set(data) - set(rma_editable_fields) - set(block_names)
+    if unknown:
+        return jsonify({"error": f"Unknown fields: {', '.join(sorted(unknown))}"}), 400
+    error = column_type_error(RMA, {key: data[key] for key in rma_editable_fields if key in data})
+    if error:
+        return jsonify({"error": error}), 400
+    for block, status_model, _ in status_blocks:
+        status_data = data.get(block, {})
+        if not isinstance(status_data, dict):
+            return jsonify({"error": f"{block} must be an object"}), 400
+        unknown = set(status_data) - set(status_columns(status_model))
+        if unknown:
+            return jsonify({"error": f"Unknown {block} fields: {', '.join(sorted(unknown))}"}), 400
+        error = column_type_error(status_model, status_data)
+        if error:
+            return jsonify({"error": f"{block}.{error}"}), 400
+
+    rma = db.session.get(RMA, id, options=rma_eager_options)
+
+    if not rma:
+        return jsonify({"error": f"RMA with ID {id} not found"}), 404
+
+    try:
+        changed = {}
+        rma_fields = apply_changes(rma, {key: data[key] for key in rma_editable_fields if key in data})
+        if rma_fields:
+            changed['rma'] = rma_fields
+
+        for block, status_model, default_data in status_blocks:
+            status_data = data.get(block)
+            if not status_data:
+                continue
+            status = getattr(rma, block)
+            if status is None:
+                status = status_model(rma=rma, **{**default_data, **status_data})
+                db.session.add(status)
+                changed[block] = list(status_data)
+            else:
+                block_fields = apply_changes(status, status_data)
+                if block_fields:
+                    changed[block] = block_fields
+            if block in changed and block in history_formats:
+                record_reading(block, rma.id, status)
+
+        if changed:
+            rma_id = rma.id
+            technician_id = rma.technician_id
+            db.session.commit()
+            invalidate_rma_cache(id, technician_id)
+            for block, block_fields in changed.items():
+                change_feed.publish('updated', rma_id, block, block_fields)
+
+        return jsonify({'success': 'RMA updated successfully', 'data': dump_rma(rma)})
+    except exc.IntegrityError:
+        db.session.rollback()
+        return jsonify({"error": "Could not update RMA. odoo_id already exists."}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": f"Could not update RMA. {str(e)}"}), 500
+
 #*****Status Enpoints*****
     #GET
-@app.route('/rma/<rma_id>/get_freeze_status', methods=["GET"])
+@api.route('/rma/<rma_id>/get_freeze_status', methods=["GET"])
+@token_required
+@cached('rma:{rma_id}')
 def get_freeze_status(rma_id):
     try:
         rma = RMA.query.get(rma_id)
@@ -454,7 +1828,9 @@ def get_freeze_status(rma_id):
     except Exception as e:
         return jsonify({"error": f"Failed to get freeze status. {str(e)}"}), 500
     
-@app.route('/rma/<rma_id>/get_heat_status', methods=["GET"])
+@api.route('/rma/<rma_id>/get_heat_status', methods=["GET"])
+@token_required
+@cached('rma:{rma_id}')
 def get_heat_status(rma_id):
     try:
         rma = RMA.query.get(rma_id)
@@ -473,7 +1849,9 @@ def get_heat_status(rma_id):
     except Exception as e:
         return jsonify({"error": f"Failed to get heat status. {str(e)}"}), 500
     
-@app.route('/rma/<rma_id>/get_vac_status', methods=["GET"])
+@api.route('/rma/<rma_id>/get_vac_status', methods=["GET"])
+@token_required
+@cached('rma:{rma_id}')
 def get_vac_status(rma_id):
     try:
         rma = RMA.query.get(rma_id)
@@ -492,7 +1870,9 @@ def get_vac_status(rma_id):
     except Exception as e:
         return jsonify({"error": f"Failed to get Vac status. {str(e)}"}), 500
     
-@app.route('/rma/<rma_id>/get_module_status', methods=["GET"])
+@api.route('/rma/<rma_id>/get_module_status', methods=["GET"])
+@token_required
+@cached('rma:{rma_id}')
 def get_module_status(rma_id):
     try:
         rma = RMA.query.get(rma_id)
@@ -512,7 +1892,9 @@ def get_module_status(rma_id):
         return jsonify({"error": f"Failed to get Module status. {str(e)}"}), 500
     
     #PUT
-@app.route('/rma/<rma_id>/update_vac_status', methods=["PUT"])
+@api.route('/rma/<rma_id>/update_vac_status', methods=["PUT"])
+@token_required
+@retry_on_lock
 def update_vac_status(rma_id):
     if request.content_type != 'application/json':
         return jsonify({"error": "Invalid content type. Expected JSON"}), 400
@@ -535,7 +1917,11 @@ def update_vac_status(rma_id):
             for key, value in vac_status_data.items():
                 setattr(vac_status, key, value)
 
+        record_reading('vac_status', rma.id, vac_status)
+        technician_id = rma.technician_id
         db.session.commit()
+        invalidate_rma_cache(rma_id, technician_id)
+        change_feed.publish('updated', vac_status.rma_id, 'vac_status', list(vac_status_data))
 
         serialized_vac_status = vac_status_schema.dump(vac_status)
 
@@ -544,7 +1930,9 @@ def update_vac_status(rma_id):
         db.session.rollback()
         return jsonify({"error": f"Could not update VacStatus. {str(e)}"}), 500
     
-@app.route('/rma/<rma_id>/update_freeze_status', methods=["PUT"])
+@api.route('/rma/<rma_id>/update_freeze_status', methods=["PUT"])
+@token_required
+@retry_on_lock
 def update_freeze_status(rma_id):
     if request.content_type != 'application/json':
         return jsonify({"error": "Invalid content type. Expected JSON"}), 400
@@ -567,7 +1955,11 @@ def update_freeze_status(rma_id):
             for key, value in freeze_status_data.items():
                 setattr(freeze_status, key, value)
 
+        record_reading('freeze_status', rma.id, freeze_status)
+        technician_id = rma.technician_id
         db.session.commit()
+        invalidate_rma_cache(rma_id, technician_id)
+        change_feed.publish('updated', freeze_status.rma_id, 'freeze_status', list(freeze_status_data))
 
         serialized_freeze_status = freeze_status_schema.dump(freeze_status)
 
@@ -576,7 +1968,9 @@ def update_freeze_status(rma_id):
         db.session.rollback()
         return jsonify({"error": f"Could not update freezeStatus. {str(e)}"}), 500
     
-@app.route('/rma/<rma_id>/update_heat_status', methods=["PUT"])
+@api.route('/rma/<rma_id>/update_heat_status', methods=["PUT"])
+@token_required
+@retry_on_lock
 def update_heat_status(rma_id):
     if request.content_type != 'application/json':
         return jsonify({"error": "Invalid content type. Expected JSON"}), 400
@@ -599,7 +1993,11 @@ def update_heat_status(rma_id):
             for key, value in heat_status_data.items():
                 setattr(heat_status, key, value)
 
+        record_reading('heat_status', rma.id, heat_status)
+        technician_id = rma.technician_id
         db.session.commit()
+        invalidate_rma_cache(rma_id, technician_id)
+        change_feed.publish('updated', heat_status.rma_id, 'heat_status', list(heat_status_data))
 
         serialized_heat_status = heat_status_schema.dump(heat_status)
 
@@ -608,7 +2006,9 @@ def update_heat_status(rma_id):
         db.session.rollback()
         return jsonify({"error": f"Could not update heatStatus. {str(e)}"}), 500
     
-@app.route('/rma/<rma_id>/update_module_status', methods=["PUT"])
+@api.route('/rma/<rma_id>/update_module_status', methods=["PUT"])
+@token_required
+@retry_on_lock
 def update_module_status(rma_id):
     if request.content_type != 'application/json':
         return jsonify({"error": "Invalid content type. Expected JSON"}), 400
@@ -631,7 +2031,10 @@ def update_module_status(rma_id):
             for key, value in module_status_data.items():
                 setattr(module_status, key, value)
 
+        technician_id = rma.technician_id
         db.session.commit()
+        invalidate_rma_cache(rma_id, technician_id)
+        change_feed.publish('updated', module_status.rma_id, 'module_status', list(module_status_data))
 
         serialized_module_status = module_status_schema.dump(module_status)
 
@@ -641,5 +2044,745 @@ def update_module_status(rma_id):
         return jsonify({"error": f"Could not update moduleStatus. {str(e)}"}), 500
 
 
+#*****Reading History*****
+
+# Each save of a test block appends one packed sample (a uint32 millisecond offset from
+# the chunk start followed by every integer column as int32) to the newest chunk row for
+# that RMA and block, so history costs one row per HISTORY_CHUNK_SAMPLES readings.
+history_blocks = ('vac_status', 'freeze_status', 'heat_status')
+history_fields = {
+    block: [name for name in status_columns(status_model) if isinstance(status_model.__table__.c[name].type, db.Integer)]
+    for block, status_model, _ in status_blocks if block in history_blocks
+}
+history_formats = {block: struct.Struct('<I' + 'i' * len(names)) for block, names in history_fields.items()}
+history_null = -2 ** 31
+max_history_points = 2000
+
+# Values an int32 slot cannot hold are recorded as missing; the save itself must not fail.
+def pack_reading(value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return history_null
+    return value if history_null < value < 2 ** 31 else history_null
+
+def record_reading(block, rma_id, status):
+    now = datetime.utcnow()
+    chunk = db.session.scalars(
+        select(ReadingHistory)
+        .where(ReadingHistory.rma_id == rma_id, ReadingHistory.block == block)
+        .order_by(ReadingHistory.started_at.desc())
+        .limit(1)
+    ).first()
+    if chunk is not None:
+        offset = int((now - chunk.started_at).total_seconds() * 1000)
+    if chunk is None or chunk.samples >= current_app.config['HISTORY_CHUNK_SAMPLES'] or not 0 <= offset < 2 ** 32:
+        chunk = ReadingHistory(rma_id=rma_id, block=block, started_at=now, ended_at=now, samples=0, data=b'')
+        db.session.add(chunk)
+        offset = 0
+    chunk.data += history_formats[block].pack(offset, *(pack_reading(getattr(status, name)) for name in history_fields[block]))
+    chunk.samples += 1
+    chunk.ended_at = now
+
+# Stored timestamps are naive UTC, so an offset such as 'Z' is converted and dropped.
+def parse_utc_timestamp(value):
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def parse_history_time(value):
+    if not value:
+        return None
+    try:
+        return parse_utc_timestamp(value)
+    except ValueError:
+        raise ValueError(f'Invalid timestamp {value}, expected ISO 8601')
+
+def unpack_readings(block, chunk):
+    for offset, *values in history_formats[block].iter_unpack(chunk.data):
+        yield chunk.started_at + timedelta(milliseconds=offset), values
+
+def downsample(samples, start, end, points):
+    if len(samples) <= points:
+        return samples
+
+    width = (end - start) / points
+    buckets = {}
+    for recorded_at, values in samples:
+        index = min(int((recorded_at - start) / width), points - 1)
+        buckets.setdefault(index, []).append(values)
+
+    series = []
+    for index in sorted(buckets):
+        rows = buckets[index]
+        means = []
+        for column in zip(*rows):
+            present = [value for value in column if value is not None]
+            means.append(round(sum(present) / len(present), 2) if present else None)
+        series.append((start + width * (index + 0.5), means))
+    return series
+
+@api.route('/rma/<int:rma_id>/history/<block>', methods=['GET'])
+@token_required
+def get_reading_history(rma_id, block):
+    if block not in history_formats:
+        return jsonify({'error': f"Unknown block. Expected one of: {', '.join(history_blocks)}"}), 400
+
+    try:
+        start = parse_history_time(request.args.get('from'))
+        end = parse_history_time(request.args.get('to'))
+        points = request.args.get('points', current_app.config['HISTORY_MAX_POINTS'], type=int)
+        if not 0 < points <= max_history_points:
+            raise ValueError(f'points must be between 1 and {max_history_points}')
+        names = history_fields[block]
+        selected = [name.strip() for name in request.args.get('fields', '').split(',') if name.strip()] or names
+        unknown = set(selected) - set(names)
+        if unknown:
+            raise ValueError(f"Unknown {block} fields: {', '.join(sorted(unknown))}")
+    except ValueError as ve:
+        return jsonify({'error': f'Failed to retrieve history. {str(ve)}'}), 400
+
+    try:
+        query = select(ReadingHistory).where(ReadingHistory.rma_id == rma_id, ReadingHistory.block == block)
+        if start is not None:
+            query = query.where(ReadingHistory.ended_at >= start)
+        if end is not None:
+            query = query.where(ReadingHistory.started_at <= end)
+
+        columns = [names.index(name) for name in selected]
+        samples = []
+        for chunk in db.session.scalars(query.order_by(ReadingHistory.started_at)):
+            for recorded_at, values in unpack_readings(block, chunk):
+                if (start is None or recorded_at >= start) and (end is None or recorded_at <= end):
+                    samples.append((recorded_at, [None if values[i] == history_null else values[i] for i in columns]))
+
+        series = []
+        if samples:
+            series = downsample(samples, start or samples[0][0], end or samples[-1][0] + timedelta(milliseconds=1), points)
+
+        return jsonify({
+            'rma_id': rma_id,
+            'block': block,
+            'fields': selected,
+            'samples': len(samples),
+            'data': [{'recorded_at': recorded_at.isoformat(), **dict(zip(selected, values))} for recorded_at, values in series],
+        })
+    except Exception as e:
+        return jsonify({'error': f'Failed to retrieve history. {str(e)}'}), 500
+
+
+#*****Search Endpoint*****
+
+max_search_page_size = 100
+
+def fts_query(text):
+    terms = [term.replace('"', '""') for term in text.split()]
+    return ' '.join(f'"{term}"*' for term in terms)
+
+@api.route('/rmas/search', methods=['GET'])
+@token_required
+@from_snapshot
+@cached('rmas')
+def search_rmas():
+    text = request.args.get('q', '').strip()
+    limit = request.args.get('limit', current_app.config['SEARCH_PAGE_SIZE'], type=int)
+    offset = request.args.get('offset', 0, type=int)
+
+    if not text:
+        return jsonify({'error': 'q is required'}), 400
+    if not 0 < limit <= max_search_page_size or offset < 0:
+        return jsonify({'error': f'limit must be between 1 and {max_search_page_size} and offset must not be negative'}), 400
+
+    try:
+        rows = report_session().execute(
+            db.text('''
+                SELECT rowid, rank, snippet(rma_search, -1, '[', ']', '...', 12)
+                FROM rma_search WHERE rma_search MATCH :query
+                ORDER BY rank LIMIT :limit OFFSET :offset
+            '''),
+            {'query': fts_query(text), 'limit': limit + 1, 'offset': offset},
+        ).all()
+
+        next_offset = offset + limit if len(rows) > limit else None
+        data = [{'id': rma_id, 'rank': rank, 'snippet': snippet} for rma_id, rank, snippet in rows[:limit]]
+        return jsonify({'data': data, 'next_offset': next_offset})
+    except Exception as e:
+        return jsonify({'error': f'Failed to search RMAs. {str(e)}'}), 500
+
+
+#*****Stats Endpoint*****
+
+@api.route('/stats', methods=['GET'])
+@token_required
+@from_snapshot
+@cached('rmas')
+def get_stats():
+    by_technician = {}
+    by_status = {}
+    by_completion = {'complete': 0, 'open': 0}
+    for row in report_session().scalars(db.select(RMAStats)):
+        completion = 'complete' if row.repair_completion else 'open'
+        technician = by_technician.setdefault(row.technician_id, {'complete': 0, 'open': 0, 'total': 0})
+        technician[completion] += row.total
+        technician['total'] += row.total
+        by_status[row.repair_status] = by_status.get(row.repair_status, 0) + row.total
+        by_completion[completion] += row.total
+
+    return jsonify({
+        'by_technician': by_technician,
+        'by_repair_status': by_status,
+        'by_repair_completion': by_completion,
+        'total': sum(by_completion.values()),
+    })
+
+
+#*****Analytics Endpoint*****
+
+analytics_tables = {
+    'vac_status': VacStatus,
+    'freeze_status': FreezeStatus,
+    'heat_status': HeatStatus,
+}
+
+analytics_metrics = {
+    'vac_status': {name: getattr(VacStatus, name) for name in ('pump_mtorr_1000', 'pump_mtorr_500', 'pump_mtorr_300', 'pump_mtorr_200', 'pump_mtorr_bo', 'mtorr_1000', 'mtorr_500', 'mtorr_300', 'mtorr_200', 'mtorr_bo')},
+    'freeze_status': {name: getattr(FreezeStatus, name) for name in ('amp_reading', 'temp_front', 'temp_mid', 'temp_back')},
+    'heat_status': {
+        **{name: getattr(HeatStatus, name) for name in ('ambient', 'heat_limit', 'max_temp', 'pad_one', 'pad_two', 'pad_three', 'pad_four', 'pad_five', 'pad_six')},
+        'pads_over_limit': sum(
+            case((getattr(HeatStatus, pad) > HeatStatus.heat_limit, 1), else_=0)
+            for pad in ('pad_one', 'pad_two', 'pad_three', 'pad_four', 'pad_five', 'pad_six')
+        ) / 6.0,
+    },
+}
+
+analytics_groups = {
+    'vac_status': {'pump_type': VacStatus.pump_type},
+    'freeze_status': {'coil_count': FreezeStatus.coil_count},
+    'heat_status': {},
+}
+rma_analytics_groups = {name: getattr(RMA, name) for name in ('technician_id', 'repair_status', 'repair_completion', 'bay')}
+analytics_percentiles = (50, 90, 95, 99)
+
+def analytics_filters():
+    filters = []
+    technician_id = request.args.get('technician_id', type=int)
+    if technician_id is not None:
+        filters.append(RMA.technician_id == technician_id)
+    repair_status = request.args.get('repair_status')
+    if repair_status:
+        filters.append(RMA.repair_status == repair_status)
+    for arg, compare in (('from', RMA.created_at.__ge__), ('to', RMA.created_at.__lt__)):
+        value = request.args.get(arg)
+        if value:
+            filters.append(compare(parse_utc_timestamp(value)))
+    return filters
+
+@api.route('/manager/analytics', methods=['GET'])
+@token_required
+@from_snapshot
+@cached('rmas')
+def get_analytics():
+    table = request.args.get('table')
+    metric = request.args.get('metric')
+    group_by = request.args.get('group_by')
+
+    if table not in analytics_tables:
+        return jsonify({'error': f"table must be one of {', '.join(analytics_tables)}"}), 400
+    if metric not in analytics_metrics[table]:
+        return jsonify({'error': f"metric must be one of {', '.join(analytics_metrics[table])}"}), 400
+    groups = {**analytics_groups[table], **rma_analytics_groups}
+    if group_by and group_by not in groups:
+        return jsonify({'error': f"group_by must be one of {', '.join(groups)}"}), 400
+
+    try:
+        filters = analytics_filters()
+    except ValueError as ve:
+        return jsonify({'error': f'Invalid date. {str(ve)}'}), 400
+
+    status_model = analytics_tables[table]
+    value = analytics_metrics[table][metric]
+    group = groups[group_by] if group_by else literal(None)
+
+    try:
+        # The default heat block stores '' in the integer ambient column, so only numeric readings count.
+        readings = (
+            select(group.label('group'), value.label('value'))
+            .select_from(status_model)
+            .join(RMA, RMA.id == status_model.rma_id)
+            .where(func.typeof(value).in_(('integer', 'real')), *filters)
+            .subquery()
+        )
+
+        summary = report_session().execute(
+            select(readings.c.group, func.count(), func.avg(readings.c.value), func.min(readings.c.value), func.max(readings.c.value))
+            .group_by(readings.c.group)
+        ).all()
+
+        ranked = select(
+            readings.c.group,
+            readings.c.value,
+            func.row_number().over(partition_by=readings.c.group, order_by=readings.c.value).label('position'),
+            func.count().over(partition_by=readings.c.group).label('total'),
+        ).subquery()
+        ranks = {p: (p * ranked.c.total + 99) // 100 for p in analytics_percentiles}
+        percentile_rows = report_session().execute(
+            select(ranked.c.group, ranked.c.position, ranked.c.total, ranked.c.value)
+            .where(or_(*[ranked.c.position == rank for rank in ranks.values()]))
+        ).all()
+
+        percentiles = {}
+        for group_value, position, total, reading in percentile_rows:
+            for p in analytics_percentiles:
+                if position == (p * total + 99) // 100:
+                    percentiles.setdefault(group_value, {})[f'p{p}'] = reading
+
+        data = [{
+            'group': group_value,
+            'count': count,
+            'mean': mean,
+            'min': minimum,
+            'max': maximum,
+            **percentiles.get(group_value, {}),
+        } for group_value, count, mean, minimum, maximum in summary]
+
+        return jsonify({'table': table, 'metric': metric, 'group_by': group_by, 'data': data})
+    except Exception as e:
+        return jsonify({'error': f'Failed to compute analytics. {str(e)}'}), 500
+
+
+#*****Sync Endpoint*****
+
+sync_models = {'rma': RMA, 'vac_status': VacStatus, 'freeze_status': FreezeStatus, 'heat_status': HeatStatus, 'module_status': ModuleStatus}
+max_sync_page_size = 5000
+
+@api.route('/sync', methods=['GET'])
+@token_required
+def sync_changes():
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', current_app.config['SYNC_PAGE_SIZE'], type=int)
+    technician_id = request.args.get('technician_id', type=int)
+
+    if since < 0 or not 0 < limit <= max_sync_page_size:
+        return jsonify({'error': f'since must not be negative and limit must be between 1 and {max_sync_page_size}'}), 400
+
+    try:
+        state = db.session.get(SyncState, 1)
+        if since > state.version or 0 < since < state.pruned_version:
+            return jsonify({'error': 'Changes since this version are no longer available. Sync again from 0', 'version': state.version}), 410
+
+        # Rows changed again after the state was read are left for the next sync.
+        changes = []
+        for name, model in sync_models.items():
+            table = model.__table__
+            query = select(table).where(table.c.version > since, table.c.version <= state.version)
+            # Filter per changed row so the version index drives the scan, not the technician's RMA count.
+            if technician_id is not None:
+                if model is RMA:
+                    query = query.where(table.c.technician_id + 0 == technician_id)
+                else:
+                    query = query.where(select(RMA.id).where(RMA.id == table.c.rma_id, RMA.technician_id == technician_id).exists())
+            for row in db.session.execute(query.order_by(table.c.version).limit(limit + 1)).mappings():
+                changes.append((row['version'], 'changed', name, dict(row)))
+
+        tombstones = select(SyncTombstone.version, SyncTombstone.table_name, SyncTombstone.row_id).where(
+            SyncTombstone.version > since, SyncTombstone.version <= state.version
+        )
+        if technician_id is not None:
+            tombstones = tombstones.where(or_(SyncTombstone.technician_id == technician_id, SyncTombstone.technician_id.is_(None)))
+        for version, name, row_id in db.session.execute(tombstones.order_by(SyncTombstone.version).limit(limit + 1)):
+            changes.append((version, 'deleted', name, row_id))
+
+        changes.sort(key=itemgetter(0))
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+
+        data = {'version': changes[-1][0] if has_more else state.version, 'has_more': has_more, 'changed': {}, 'deleted': {}}
+        for version, change, name, value in changes:
+            data[change].setdefault(name, []).append(value)
+        return jsonify(data)
+    except Exception as e:
+        return jsonify({'error': f'Failed to sync changes. {str(e)}'}), 500
+
+
+#***** Background Jobs *****
+
+job_kinds = {}
+
+def job_kind(name, on_success=None, parse_params=None):
+  def decorator(handler):
+    job_kinds[name] = (handler, on_success, parse_params)
+    return handler
+  return decorator
+
+def job_result_path(job_id, filename):
+  os.makedirs(current_app.config['JOB_RESULTS_DIR'], exist_ok=True)
+  return os.path.join(current_app.config['JOB_RESULTS_DIR'], f'{job_id}-{filename}')
+
+@job_kind('export_rmas')
+def export_rmas_job(job_id, params):
+  path = job_result_path(job_id, 'rmas.ndjson.gz')
+  count = 0
+  with gzip.open(path, 'wt', compresslevel=current_app.config['COMPRESS_GZIP_LEVEL']) as f:
+    for line in rma_export_lines():
+      f.write(line)
+      count += 1
+  return {'rmas': count}, path
+
+def after_delete_all_rmas(job):
+  response_cache.clear()
+  change_feed.publish('deleted_all', None, 'rma')
+
+@job_kind('delete_all_rmas', on_success=after_delete_all_rmas)
+def delete_all_rmas_job(job_id, params):
+  deleted = purge_rmas([])
+  return {'deleted': deleted, 'freed_pages': reclaim_free_pages()}, None
+
+@job_kind('refresh_snapshot')
+def refresh_snapshot_job(job_id, params):
+  snapshot = current_app.extensions.get('report_snapshot')
+  if snapshot is None:
+    raise ValueError('SNAPSHOT_PATH is not configured')
+  return {'bytes': snapshot.refresh(db.engine)}, None
+
+worker_app = None
+
+# Runs in a job worker process; the parent only records the outcome.
+def run_job(config, job_id, kind, params):
+  global worker_app
+  if worker_app is None:
+    worker_app = create_app(config)
+  with worker_app.app_context():
+    return job_kinds[kind][0](job_id, params)
+
+def claim_job():
+  now = datetime.utcnow()
+  candidate = db.select(Job.id).where(or_(
+    db.and_(Job.status == 'queued', Job.run_after <= now),
+    db.and_(Job.status == 'running', Job.locked_until < now),
+  )).order_by(Job.id).limit(1).scalar_subquery()
+  job = db.session.execute(
+    db.update(Job).where(Job.id == candidate).values(
+      status='running',
+      attempts=Job.attempts + 1,
+      started_at=now,
+      locked_until=now + timedelta(seconds=current_app.config['JOB_TIMEOUT']),
+    ).returning(Job.id, Job.kind, Job.params)
+  ).first()
+  db.session.commit()
+  return job
+
+def complete_job(job_id, result, result_path):
+  job = db.session.get(Job, job_id)
+  job.status = 'succeeded'
+  job.result = result
+  job.result_path = result_path
+  job.error = None
+  job.locked_until = None
+  job.finished_at = datetime.utcnow()
+  db.session.commit()
+  on_success = job_kinds[job.kind][1]
+  if on_success is not None:
+    on_success(job)
+
+def fail_job(job_id, error):
+  job = db.session.get(Job, job_id)
+  job.error = error
+  job.locked_until = None
+  if job.attempts < job.max_attempts:
+    job.status = 'queued'
+    job.run_after = datetime.utcnow() + timedelta(seconds=current_app.config['JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1))
+  else:
+    job.status = 'failed'
+    job.finished_at = datetime.utcnow()
+  db.session.commit()
+
+class JobRunner:
+  def __init__(self, app):
+    self.app = app
+    self.pool = None
+    self.thread = None
+    self.slots = None
+    self.wakeup = threading.Event()
+    self.lock = threading.Lock()
+
+  def start(self):
+    with self.lock:
+      if self.thread is None:
+        self.slots = threading.BoundedSemaphore(self.app.config['JOB_WORKERS'])
+        self.thread = threading.Thread(target=self.run, name='job-runner', daemon=True)
+        self.thread.start()
+    return self.thread
+
+  def notify(self):
+    self.start()
+    self.wakeup.set()
+
+  def get_pool(self):
+    with self.lock:
+      if self.pool is None:
+        self.pool = ProcessPoolExecutor(max_workers=self.app.config['JOB_WORKERS'], mp_context=multiprocessing.get_context('spawn'))
+      return self.pool
+
+  def run(self):
+    while True:
+      self.slots.acquire()
+      try:
+        with self.app.app_context():
+          job = claim_job()
+          if job is not None:
+            try:
+              future = self.get_pool().submit(run_job, dict(self.app.config), job.id, job.kind, job.params)
+            except Exception as e:
+              fail_job(job.id, f'Could not start job. {str(e)}')
+              raise
+        if job is not None:
+          future.add_done_callback(partial(self.finish, job.id))
+          continue
+      except Exception:
+        self.app.logger.exception('Could not start a job')
+      self.slots.release()
+      self.wakeup.wait(self.app.config['JOB_POLL_INTERVAL'])
+      self.wakeup.clear()
+
+  def finish(self, job_id, future):
+    try:
+      with self.app.app_context():
+        try:
+          result, result_path = future.result()
+        except BrokenProcessPool as e:
+          with self.lock:
+            self.pool = None
+          fail_job(job_id, f'Job worker exited unexpectedly. {str(e)}')
+        except Exception as e:
+          fail_job(job_id, str(e))
+        else:
+          complete_job(job_id, result, result_path)
+    except Exception:
+      self.app.logger.exception('Could not record the outcome of job %s', job_id)
+    finally:
+      self.slots.release()
+      self.wakeup.set()
+
+job_runner = LocalProxy(lambda: current_app.extensions['job_runner'])
+
+@api.cli.command('run-jobs')
+def run_jobs_command():
+  print(f"Running jobs with {current_app.config['JOB_WORKERS']} workers")
+  job_runner.start().join()
+
+@api.route('/jobs', methods=['POST'])
+@token_required
+@retry_on_lock
+def enqueue_job():
+    if request.content_type != 'application/json':
+        return jsonify({"error": "Invalid content type. Expected JSON"}), 400
+
+    data = request.get_json()
+    kind = data.get('kind')
+    params = data.get('params', {})
+    if kind not in job_kinds:
+        return jsonify({'error': f"Unknown job kind. Expected one of: {', '.join(sorted(job_kinds))}"}), 400
+    if not isinstance(params, dict):
+        return jsonify({'error': 'params must be an object'}), 400
+    parse_params = job_kinds[kind][2]
+    if parse_params is not None:
+        try:
+            parse_params(params)
+        except ValueError as ve:
+            return jsonify({'error': f'Invalid params. {str(ve)}'}), 400
+
+    try:
+        job = Job(kind=kind, params=params, max_attempts=current_app.config['JOB_MAX_ATTEMPTS'], created_by=g.current_user['id'])
+        db.session.add(job)
+        db.session.commit()
+        job_runner.notify()
+
+        response = jsonify(job_schema.dump(job))
+        response.status_code = 202
+        response.headers['Location'] = url_for('.get_job', job_id=job.id)
+        return response
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Could not enqueue job. {str(e)}'}), 500
+
+@api.route('/jobs/<int:job_id>', methods=['GET'])
+@token_required
+def get_job(job_id):
+    job = db.session.get(Job, job_id)
+    if not job:
+        return jsonify({'error': f'Job with ID {job_id} not found'}), 404
+    if job.status in ('queued', 'running'):
+        job_runner.start()
+    return jsonify(job_schema.dump(job))
+
+@api.route('/jobs/<int:job_id>/result', methods=['GET'])
+@token_required
+def get_job_result(job_id):
+    job = db.session.get(Job, job_id)
+    if not job:
+        return jsonify({'error': f'Job with ID {job_id} not found'}), 404
+    if job.status != 'succeeded':
+        return jsonify({'error': f'Job is {job.status}', 'job': job_schema.dump(job)}), 409
+    if job.result_path is None:
+        return jsonify(job.result)
+    if not os.path.exists(job.result_path):
+        return jsonify({'error': 'Job result file is no longer available'}), 410
+    return send_file(job.result_path, mimetype='application/gzip', as_attachment=True, download_name=os.path.basename(job.result_path))
+
+
+#***** Purge *****
+
+purge_tables = (VacStatus, FreezeStatus, HeatStatus, ModuleStatus, ReadingHistory)
+
+def purge_filters(params):
+  filters = []
+  completed = params.get('completed')
+  if completed is not None:
+    if not isinstance(completed, bool):
+      raise ValueError('completed must be true or false')
+    filters.append(RMA.repair_completion == completed)
+  older_than_days = params.get('older_than_days')
+  if older_than_days is not None:
+    if not isinstance(older_than_days, int) or older_than_days < 0:
+      raise ValueError('older_than_days must be a non-negative integer')
+    # Rows from before created_at existed have no timestamp and count as old.
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    filters.append(or_(RMA.created_at < cutoff, RMA.created_at.is_(None)))
+  repair_status = params.get('repair_status')
+  if repair_status is not None:
+    filters.append(RMA.repair_status == repair_status)
+  technician_id = params.get('technician_id')
+  if technician_id is not None:
+    if not isinstance(technician_id, int):
+      raise ValueError('technician_id must be an integer')
+    filters.append(RMA.technician_id == technician_id)
+  unknown = set(params) - {'completed', 'older_than_days', 'repair_status', 'technician_id'}
+  if unknown:
+    raise ValueError(f"Unknown purge filters: {', '.join(sorted(unknown))}")
+  return filters
+
+def purge_rmas(filters):
+  batch_size = current_app.config['PURGE_BATCH_SIZE']
+  deleted = 0
+  after = 0
+  while True:
+    rma_ids = db.session.scalars(select(RMA.id).where(RMA.id > after, *filters).order_by(RMA.id).limit(batch_size)).all()
+    if not rma_ids:
+      return deleted
+    for model in purge_tables:
+      db.session.execute(db.delete(model).where(model.rma_id.in_(rma_ids)).execution_options(synchronize_session=False))
+    db.session.execute(db.delete(RMA).where(RMA.id.in_(rma_ids)).execution_options(synchronize_session=False))
+    db.session.commit()
+    deleted += len(rma_ids)
+    after = rma_ids[-1]
+    time.sleep(current_app.config['PURGE_PAUSE'])
+
+# Clients that last synced before the newest pruned tombstone are told to sync again from 0.
+def prune_sync_tombstones():
+  cutoff = datetime.utcnow() - timedelta(days=current_app.config['SYNC_TOMBSTONE_DAYS'])
+  pruned_version = db.session.scalar(select(func.max(SyncTombstone.version)).where(SyncTombstone.deleted_at < cutoff))
+  if pruned_version is None:
+    return 0
+  pruned = db.session.execute(db.delete(SyncTombstone).where(SyncTombstone.version <= pruned_version)).rowcount
+  db.session.execute(db.update(SyncState).values(pruned_version=pruned_version))
+  db.session.commit()
+  return pruned
+
+def reclaim_free_pages():
+  step = current_app.config['VACUUM_STEP_PAGES']
+  freed = 0
+  with db.engine.connect() as conn:
+    raw = conn.connection.dbapi_connection
+    # Deleted rows stay in the FTS index as tombstones until their segments are merged; a
+    # negative merge size folds every segment, step pages at a time.
+    while True:
+      changes = raw.total_changes
+      conn.exec_driver_sql("INSERT INTO rma_search (rma_search, rank) VALUES ('merge', ?)", (-step,))
+      conn.commit()
+      if raw.total_changes - changes < 2:
+        break
+      time.sleep(current_app.config['PURGE_PAUSE'])
+
+    if conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() != 2:
+      return 0
+    free_pages = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+    while free_pages:
+      # pysqlite's execute() steps a statement once, which frees a single page; executescript runs it to completion.
+      raw.executescript(f'PRAGMA incremental_vacuum({step})')
+      remaining = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+      if remaining >= free_pages:
+        break
+      freed += free_pages - remaining
+      free_pages = remaining
+      time.sleep(current_app.config['PURGE_PAUSE'])
+    conn.exec_driver_sql('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+  return freed
+
+def after_purge_rmas(job):
+  response_cache.clear()
+  change_feed.publish('purged', None, 'rma', sorted(job.params))
+
+@job_kind('purge_rmas', on_success=after_purge_rmas, parse_params=purge_filters)
+def purge_rmas_job(job_id, params):
+  deleted = purge_rmas(purge_filters(params))
+  pruned = prune_sync_tombstones()
+  return {'deleted': deleted, 'pruned_tombstones': pruned, 'freed_pages': reclaim_free_pages()}, None
+
+
+#***** App Factory *****
+
+app_engines = weakref.WeakSet()
+
+# A pooled SQLite connection must never be used by two processes, so a forked worker
+# (gunicorn --preload) drops the inherited connections without closing them and opens its own.
+def dispose_engines_after_fork():
+  for engine in list(app_engines):
+    engine.dispose(close=False)
+
+os.register_at_fork(after_in_child=dispose_engines_after_fork)
+
+# gunicorn --preload -w 4 'app:create_app()'
+def create_app(config=None):
+  app = Flask(__name__)
+  app.config.from_mapping(copy.deepcopy(default_config))
+  if 'DATABASE_URL' in os.environ:
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
+  app.config.from_mapping(config or {})
+  memory_database = make_url(app.config['SQLALCHEMY_DATABASE_URI']).database in (None, '', ':memory:')
+  if memory_database:
+    # Flask-SQLAlchemy gives in-memory SQLite a StaticPool, which takes no pool sizing.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+      key: value for key, value in app.config['SQLALCHEMY_ENGINE_OPTIONS'].items()
+      if key not in ('pool_size', 'max_overflow', 'pool_timeout')
+    }
+
+  CORS(app)
+  db.init_app(app)
+  ma.init_app(app)
+  app.register_blueprint(api)
+  app.extensions['auth_cache'] = AuthCache(app.config['AUTH_CACHE_SIZE'], app.config['AUTH_CACHE_TTL'])
+  app.extensions['response_cache'] = ResponseCache(app.config['RESPONSE_CACHE_SIZE'], app.config['RESPONSE_CACHE_TTL'])
+  app.extensions['change_feed'] = ChangeFeed(app.config['CHANGE_FEED_BUFFER'])
+  app.extensions['job_runner'] = JobRunner(app)
+  app.teardown_appcontext(close_report_session)
+
+  with app.app_context():
+    for engine in db.engines.values():
+      event.listen(engine, 'connect', partial(configure_sqlite, app.config['SQLITE_PRAGMAS']))
+      app_engines.add(engine)
+    init_db()
+    app.extensions['cache_stamp'] = CacheStamp(None if memory_database else db.engine.url.database)
+    if app.config['SNAPSHOT_PATH'] is not None:
+      snapshot = app.extensions['report_snapshot'] = ReportSnapshot(app.config['SNAPSHOT_PATH'], app.config['SQLALCHEMY_ENGINE_OPTIONS'], app.config['SQLITE_PRAGMAS'])
+      app_engines.add(snapshot.engine)
+    # Schema setup runs once, in the master under --preload; workers start with an empty pool.
+    # Disposing an in-memory database's only connection would drop the database with it.
+    if not memory_database:
+      db.engine.dispose()
+  return app
+
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
@@ -0,0 +1,255 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qsl
+
+import jwt
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from werkzeug.datastructures import Accept, MIMEAccept, MultiDict
+from werkzeug.http import parse_accept_header, parse_cookie
+
+from app import (
+  create_app, AccountInfo, RMA, apply_sqlite_pragmas, auth_cache, cache_account, cache_entry, cache_stamp,
+  cached_representation, dump_rma, encode_rma_list, format_sse, negotiate_encoding, negotiate_format,
+  observe_request, parse_rma_page_args, response_cache, rma_eager_options, rma_page_query, rma_page_result,
+  stream_token,
+)
+
+# Run with: uvicorn asgi:application --workers 4 --timeout-graceful-shutdown 5
+# (open /rma/events streams never finish on their own, so shutdown needs the timeout to end them).
+# GET /rma/<id>, GET /manager/rmas and the /rma/events stream are served natively on
+# aiosqlite; every other route is handed to the Flask app on a thread pool sized to the
+# database pool.
+
+app = create_app()
+
+async_engine = create_async_engine(
+  app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite://', 'sqlite+aiosqlite://', 1),
+  poolclass=AsyncAdaptedQueuePool,
+  **app.config['SQLALCHEMY_ENGINE_OPTIONS'],
+)
+event.listen(async_engine.sync_engine, 'connect', partial(apply_sqlite_pragmas, app.config['SQLITE_PRAGMAS']))
+async_session = async_sessionmaker(async_engine, expire_on_commit=False)
+
+engine_options = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+wsgi_executor = ThreadPoolExecutor(max_workers=engine_options['pool_size'] + engine_options['max_overflow'])
+
+
+# Stock WsgiToAsgi runs every request on a single thread-sensitive executor, which
+# serialises the Flask routes and fails with "CurrentThreadExecutor already quit"
+# once requests overlap.
+class ThreadedWsgiToAsgiInstance(WsgiToAsgiInstance):
+  run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func, thread_sensitive=False, executor=wsgi_executor)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+  async def __call__(self, scope, receive, send):
+    await ThreadedWsgiToAsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+
+wsgi_application = ThreadedWsgiToAsgi(app)
+
+
+class HTTPError(Exception):
+  def __init__(self, status, message):
+    self.status = status
+    self.message = message
+
+
+async def authenticate(session, headers, fallback_token=None):
+  auth_header = headers.get('authorization', '')
+  token = auth_header[len('Bearer '):] if auth_header.startswith('Bearer ') else fallback_token
+  if not token:
+    raise HTTPError(401, 'Authorization token is required')
+
+  user = auth_cache.get(token)
+  if user is not None:
+    return user
+
+  try:
+    payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+    user = cache_account(token, payload, await session.get(AccountInfo, payload['user_id']))
+  except jwt.ExpiredSignatureError:
+    raise HTTPError(401, 'Token has expired')
+  except (jwt.InvalidTokenError, KeyError):
+    raise HTTPError(401, 'Invalid token')
+
+  if user is None:
+    raise HTTPError(401, 'Invalid token')
+  return user
+
+
+async def get_rma(session, rma_id, args):
+  rma = await session.get(RMA, int(rma_id), options=rma_eager_options)
+  if not rma:
+    raise HTTPError(404, f'RMA with ID {rma_id} not found')
+  return dump_rma(rma)
+
+
+async def get_all_rmas(session, args):
+  try:
+    only, limit, after = parse_rma_page_args(args)
+  except ValueError as ve:
+    raise HTTPError(400, f'Failed to retrieve RMAs. {str(ve)}')
+  rmas = (await session.scalars(rma_page_query(select(RMA), only, limit, after))).unique().all()
+  return rma_page_result(rmas, only, limit)
+
+
+def match_route(method, path):
+  if method != 'GET':
+    return None, ()
+  # With a report snapshot configured, Flask routes the list to the replica and adds its staleness headers.
+  if path == '/manager/rmas' and 'report_snapshot' not in app.extensions:
+    return get_all_rmas, ()
+  parts = path.split('/')
+  if len(parts) == 3 and parts[1] == 'rma' and parts[2].isdigit():
+    return get_rma, (parts[2],)
+  return None, ()
+
+
+async def send_response(send, status, body, headers):
+  headers = headers + [('Content-Length', str(len(body)))]
+  await send({'type': 'http.response.start', 'status': status, 'headers': [(k.encode(), v.encode()) for k, v in headers]})
+  await send({'type': 'http.response.body', 'body': body})
+
+
+async def serve_native(handler, params, scope, send):
+  started = time.perf_counter()
+  headers = request_headers(scope)
+  query_string = scope['query_string'].decode('latin-1')
+  response_format = negotiate_format(parse_accept_header(headers.get('accept'), MIMEAccept))
+  cache_key = f"{response_format}:{scope['path']}?{query_string}"
+  response_headers = []
+  if 'origin' in headers:
+    response_headers.append(('Access-Control-Allow-Origin', '*'))
+
+  try:
+    async with async_session() as session:
+      await authenticate(session, headers)
+      stamp = cache_stamp.read()
+      entry = response_cache.get(cache_key, stamp)
+      if entry is None:
+        generation = response_cache.generation
+        data = await handler(session, *params, MultiDict(parse_qsl(query_string)))
+        if handler is get_all_rmas:
+          entry = cache_entry(*encode_rma_list(data, response_format))
+        else:
+          entry = cache_entry((json.dumps(data, sort_keys=True, separators=(',', ':')) + '\n').encode(), 'application/json')
+        tag = 'rmas' if handler is get_all_rmas else f'rma:{params[0]}'
+        response_cache.put(cache_key, entry, [tag], generation, stamp)
+  except HTTPError as e:
+    body = (json.dumps({'error': e.message}, separators=(',', ':')) + '\n').encode()
+    return await send_response(send, e.status, body, response_headers + [('Content-Type', 'application/json')])
+
+  encoding = negotiate_encoding(parse_accept_header(headers.get('accept-encoding'), Accept))
+  body, etag, mimetype, encoding = cached_representation(entry, encoding)
+  response_headers.append(('Content-Type', mimetype))
+  response_headers.append(('Vary', 'Accept, Accept-Encoding'))
+  if encoding:
+    response_headers.append(('Content-Encoding', encoding))
+    response_headers.append(('ETag', f'W/"{etag}"'))
+  else:
+    response_headers.append(('ETag', f'"{etag}"'))
+  if etag in headers.get('if-none-match', ''):
+    status, body = 304, b''
+  else:
+    status = 200
+  await send_response(send, status, body, response_headers)
+  observe_request(f'api.{handler.__name__}', {
+    'http_request_duration_seconds': time.perf_counter() - started,
+    'http_response_size_bytes': len(body),
+  })
+
+
+def request_headers(scope):
+  return {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+
+
+async def wait_for_disconnect(receive):
+  while (await receive())['type'] != 'http.disconnect':
+    pass
+
+
+# Each subscriber is a coroutine parked on the change feed, so it holds neither a thread from
+# wsgi_executor nor a database connection once the token is checked.
+async def serve_events(scope, receive, send):
+  headers = request_headers(scope)
+  cors_headers = [('Access-Control-Allow-Origin', '*')] if 'origin' in headers else []
+
+  args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1')))
+  try:
+    async with async_session() as session:
+      await authenticate(session, headers, stream_token(args, parse_cookie(headers.get('cookie'))))
+  except HTTPError as e:
+    body = (json.dumps({'error': e.message}, separators=(',', ':')) + '\n').encode()
+    return await send_response(send, e.status, body, cors_headers + [('Content-Type', 'application/json')])
+
+  try:
+    last_event_id = int(headers['last-event-id'])
+  except (KeyError, ValueError):
+    last_event_id = None
+  feed = app.extensions['change_feed']
+  keepalive = app.config['CHANGE_FEED_KEEPALIVE']
+
+  async def stream():
+    response_headers = cors_headers + [('Content-Type', 'text/event-stream'), ('Cache-Control', 'no-cache'), ('X-Accel-Buffering', 'no')]
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [(k.encode(), v.encode()) for k, v in response_headers]})
+    after_id, reset = feed.resume_point(last_event_id)
+    if reset:
+      await send({'type': 'http.response.body', 'body': format_sse(after_id, 'reset', {'last_id': after_id}).encode(), 'more_body': True})
+    while True:
+      events = await feed.wait_async(after_id, keepalive)
+      if events:
+        chunk = ''.join(format_sse(event_id, 'rma_change', change) for event_id, change in events)
+        after_id = events[-1][0]
+      else:
+        chunk = ': keep-alive\n\n'
+      await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+
+  # The server drops writes to a closed connection silently, so the stream ends when the client's
+  # disconnect arrives rather than on a failed send.
+  tasks = [asyncio.ensure_future(stream()), asyncio.ensure_future(wait_for_disconnect(receive))]
+  done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+  for task in pending:
+    task.cancel()
+  await asyncio.gather(*pending, return_exceptions=True)
+  for task in done:
+    task.result()
+
+
+# aiosqlite runs each connection on a non-daemon thread, so the pool must be closed before the
+# interpreter can exit; without this uvicorn logs "Finished server process" and keeps running.
+async def lifespan(receive, send):
+  while True:
+    message = await receive()
+    if message['type'] == 'lifespan.startup':
+      await send({'type': 'lifespan.startup.complete'})
+    elif message['type'] == 'lifespan.shutdown':
+      await async_engine.dispose()
+      wsgi_executor.shutdown(wait=False)
+      await send({'type': 'lifespan.shutdown.complete'})
+      return
+
+
+async def application(scope, receive, send):
+  if scope['type'] == 'lifespan':
+    return await lifespan(receive, send)
+  if scope['type'] != 'http':
+    return await wsgi_application(scope, receive, send)
+
+  if scope['method'] == 'GET' and scope['path'] == '/rma/events':
+    with app.app_context():
+      return await serve_events(scope, receive, send)
+
+  handler, params = match_route(scope['method'], scope['path'])
+  if handler is None:
+    return await wsgi_application(scope, receive, send)
+
+  with app.app_context():
+    await serve_native(handler, params, scope, send)
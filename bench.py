@@ -0,0 +1,474 @@
+import argparse
+import http.client
+import importlib
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+# python bench.py generate --db /tmp/bench.sqlite --accounts 20 --rmas 5000
+# python bench.py run --db /tmp/bench.sqlite --out baseline.json
+# DATABASE_URL=sqlite:////tmp/bench.sqlite uvicorn asgi:application &
+# python bench.py run --db /tmp/bench.sqlite --url http://127.0.0.1:8000 --out live.json
+# python bench.py compare baseline.json current.json
+#
+# Scenarios write to the database, so regenerate it (same --seed) before each run
+# that will be compared against a baseline.
+
+bench_password = 'bench-password'
+
+repair_statuses = ('Intake', 'Diagnosis', 'Awaiting Parts', 'In Repair', 'Testing', 'Complete')
+repair_status_weights = (10, 15, 10, 20, 15, 30)
+pump_types = ('JB Eliminator', 'Robinair 15800', 'Edwards RV5', 'Yellow Jacket SuperEvac')
+repair_notes = (
+  'Unit will not pull below 500 mTorr',
+  'Freezer coils not reaching temp',
+  'Heater pad three open circuit',
+  'Customer reports door seal leak',
+  'Vacuum gauge reading erratic',
+  'Module fails self test on boot',
+  'Pump oil contaminated, flushed and refilled',
+)
+repair_parts = ('door seal', 'vacuum sensor', 'heater pad', 'control module', 'pump oil', 'solenoid valve', 'thermocouple')
+module_parts = ('', 'control board', 'display board', 'power supply', 'relay board')
+
+scenario_requests = {
+  'intake': 200,
+  'bench_save': 500,
+  'wallboard': 1000,
+  'login': 50,
+  'mixed': 1000,
+}
+
+
+#***** Synthetic Data *****
+
+def vac_reading(rng):
+  return {
+    'pump_type': rng.choice(pump_types),
+    'pump_sn': f'VP{rng.randint(100000, 999999)}',
+    'pump_mtorr_1000': rng.randint(950, 1050),
+    'pump_mtorr_500': rng.randint(470, 530),
+    'pump_mtorr_300': rng.randint(280, 320),
+    'pump_mtorr_200': rng.randint(185, 215),
+    'pump_mtorr_bo': rng.randint(15, 60),
+    'mtorr_1000': rng.randint(980, 1100),
+    'mtorr_500': rng.randint(490, 580),
+    'mtorr_300': rng.randint(295, 360),
+    'mtorr_200': rng.randint(195, 260),
+    'mtorr_bo': rng.randint(25, 150),
+  }
+
+def freeze_reading(rng):
+  return {
+    'coil_count': rng.choice(('1', '2', '3')),
+    'amp_reading': rng.randint(3, 9),
+    'temp_front': rng.randint(-40, -15),
+    'temp_mid': rng.randint(-40, -15),
+    'temp_back': rng.randint(-40, -15),
+  }
+
+def heat_reading(rng):
+  return {
+    'ambient': rng.randint(18, 26),
+    'heat_limit': rng.choice((70, 75, 80)),
+    'max_temp': rng.randint(55, 80),
+    'pad_one': rng.randint(40, 75),
+    'pad_two': rng.randint(40, 75),
+    'pad_three': rng.randint(40, 75),
+    'pad_four': rng.randint(40, 75),
+    'pad_five': rng.randint(40, 75),
+    'pad_six': rng.randint(40, 75),
+  }
+
+def module_reading(rng):
+  return {'replaced_parts': rng.choice(module_parts)}
+
+status_readings = {
+  'vac_status': vac_reading,
+  'freeze_status': freeze_reading,
+  'heat_status': heat_reading,
+  'module_status': module_reading,
+}
+
+def synthetic_rma(rng, odoo_id):
+  repair_status = rng.choices(repair_statuses, repair_status_weights)[0]
+  rma = {
+    'odoo_id': odoo_id,
+    'fd_sn': f'FD{rng.randint(1000000, 9999999)}',
+    'bay': rng.randint(1, 12),
+    'repair_status': repair_status,
+    'repair_notes': rng.choice(repair_notes),
+    'repair_parts': ', '.join(rng.sample(repair_parts, rng.randint(0, 3))),
+    'repair_completion': repair_status == 'Complete',
+  }
+  # RMAs still in intake or diagnosis have not been on the bench yet and keep the default readings.
+  if repair_status not in ('Intake', 'Diagnosis'):
+    for block, reading in status_readings.items():
+      rma[block] = reading(rng)
+  return rma
+
+
+#***** Generator *****
+
+def load_app(db_path):
+  rma_app = importlib.import_module('app')
+  return rma_app, rma_app.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.abspath(db_path)})
+
+def generate(args):
+  for suffix in ('', '-wal', '-shm'):
+    if os.path.exists(args.db + suffix):
+      if not args.force:
+        sys.exit(f'{args.db} already exists, pass --force to replace it')
+      os.remove(args.db + suffix)
+
+  rng = random.Random(args.seed)
+  rma_app, app = load_app(args.db)
+  db, insert = rma_app.db, rma_app.insert
+  now = datetime.utcnow()
+  started = time.perf_counter()
+
+  with app.app_context():
+    password_hash = rma_app.hash_password(bench_password)
+    accounts = [{
+      'user_name': f'bench{index}',
+      'user_email': f'bench{index}@example.com',
+      'user_password_hash': password_hash,
+      'user_auth': 1 if index == 0 else 0,
+    } for index in range(args.accounts)]
+    technician_ids = db.session.scalars(insert(rma_app.AccountInfo).returning(rma_app.AccountInfo.id, sort_by_parameter_order=True), accounts).all()
+
+    for offset in range(0, args.rmas, args.batch_size):
+      items = [synthetic_rma(rng, odoo_id) for odoo_id in range(offset + 1, min(offset + args.batch_size, args.rmas) + 1)]
+      rma_rows = [{
+        **{key: item[key] for key in rma_app.rma_editable_fields},
+        'technician_id': rng.choice(technician_ids),
+        'created_at': now - timedelta(seconds=rng.randint(0, 365 * 24 * 3600)),
+      } for item in items]
+      rma_ids = db.session.scalars(insert(rma_app.RMA).returning(rma_app.RMA.id, sort_by_parameter_order=True), rma_rows).all()
+
+      for block, status_model, default_data in rma_app.status_blocks:
+        db.session.execute(insert(status_model), [
+          {**default_data, **item.get(block, {}), 'rma_id': rma_id} for rma_id, item in zip(rma_ids, items)
+        ])
+      db.session.commit()
+
+  print(f'Generated {args.accounts} accounts and {args.rmas} RMAs in {args.db} in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+
+
+#***** Targets *****
+
+class ClientTarget:
+  def __init__(self, db_path):
+    self.app = load_app(db_path)[1]
+    self.local = threading.local()
+    self.name = 'flask-test-client'
+
+  def request(self, method, path, body=None, headers=None):
+    client = getattr(self.local, 'client', None)
+    if client is None:
+      client = self.local.client = self.app.test_client()
+    response = client.open(path, method=method, json=body, headers=headers)
+    return response.status_code, response.headers, response.get_data()
+
+
+class HTTPTarget:
+  def __init__(self, url):
+    parts = urlsplit(url)
+    self.host = parts.hostname
+    self.port = parts.port or 80
+    self.local = threading.local()
+    self.name = url
+
+  def request(self, method, path, body=None, headers=None):
+    headers = dict(headers or {})
+    payload = None
+    if body is not None:
+      payload = json.dumps(body).encode()
+      headers['Content-Type'] = 'application/json'
+
+    for attempt in range(2):
+      connection = getattr(self.local, 'connection', None)
+      if connection is None:
+        connection = self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+      try:
+        connection.request(method, path, payload, headers)
+        response = connection.getresponse()
+        return response.status, response.headers, response.read()
+      except (http.client.HTTPException, ConnectionError):
+        connection.close()
+        self.local.connection = None
+        if attempt:
+          raise
+
+
+metric_line = re.compile(r'^http_request_db_statements_(sum|count)\{endpoint="([^"]+)"\} (\S+)$')
+
+def sql_totals(target):
+  status, _, body = target.request('GET', '/metrics')
+  totals = {}
+  if status != 200:
+    return totals
+  for line in body.decode().splitlines():
+    match = metric_line.match(line)
+    if match and match.group(2) != 'api.metrics':
+      kind, endpoint, value = match.groups()
+      totals.setdefault(endpoint, {'sum': 0.0, 'count': 0.0})[kind] = float(value)
+  return totals
+
+def sql_per_request(before, after):
+  statements = requests = 0.0
+  for endpoint, totals in after.items():
+    previous = before.get(endpoint, {'sum': 0.0, 'count': 0.0})
+    statements += totals['sum'] - previous['sum']
+    requests += totals['count'] - previous['count']
+  if not requests:
+    return None
+  return round(statements / requests, 2)
+
+
+#***** Scenarios *****
+
+class Fixtures:
+  def __init__(self, db_path, target):
+    conn = sqlite3.connect(db_path)
+    self.accounts = conn.execute("SELECT id, user_email FROM account_info WHERE user_email LIKE 'bench%@example.com' ORDER BY id").fetchall()
+    self.rma_ids = [row[0] for row in conn.execute('SELECT id FROM rma ORDER BY id')]
+    self.next_odoo_id = itertools.count((conn.execute('SELECT max(odoo_id) FROM rma').fetchone()[0] or 0) + 1)
+    conn.close()
+    if not self.accounts or not self.rma_ids:
+      sys.exit(f'{db_path} has no benchmark data, run the generate command first')
+
+    status, _, body = target.request('POST', '/login', {'user_email': self.accounts[0][1], 'user_password': bench_password})
+    if status != 200:
+      sys.exit(f'Could not log in as {self.accounts[0][1]}: {status} {body[:200]!r}')
+    self.auth = {'Authorization': f"Bearer {json.loads(body)['token']}"}
+    self.local = threading.local()
+
+
+def intake(fixtures, rng):
+  technician_id = rng.choice(fixtures.accounts)[0]
+  return 'POST', f'/{technician_id}/create_rma', synthetic_rma(rng, next(fixtures.next_odoo_id)), fixtures.auth, (200,)
+
+def bench_save(fixtures, rng):
+  block = rng.choice(tuple(status_readings))
+  body = {'data': status_readings[block](rng)}
+  return 'PUT', f'/rma/{rng.choice(fixtures.rma_ids)}/update_{block}', body, fixtures.auth, (200,)
+
+def wallboard(fixtures, rng):
+  headers = {**fixtures.auth, 'Accept-Encoding': 'gzip'}
+  etag = getattr(fixtures.local, 'etag', None)
+  if etag:
+    headers['If-None-Match'] = etag
+  return 'GET', '/manager/rmas?limit=100', None, headers, (200, 304)
+
+def login(fixtures, rng):
+  email = rng.choice(fixtures.accounts)[1]
+  return 'POST', '/login', {'user_email': email, 'user_password': bench_password}, None, (200,)
+
+def mixed(fixtures, rng):
+  if rng.random() < 0.1:
+    return bench_save(fixtures, rng)
+  return wallboard(fixtures, rng)
+
+scenarios = {
+  'intake': intake,
+  'bench_save': bench_save,
+  'wallboard': wallboard,
+  'login': login,
+  'mixed': mixed,
+}
+
+
+#***** Runner *****
+
+def percentile(ordered, p):
+  return ordered[max(0, (p * len(ordered) + 99) // 100 - 1)]
+
+def run_scenario(target, fixtures, name, total, concurrency, warmup, seed):
+  scenario = scenarios[name]
+  counter = itertools.count()
+  latencies = []
+  errors = []
+  lock = threading.Lock()
+
+  def worker(worker_id):
+    rng = random.Random(f'{seed}:{name}:{worker_id}')
+    fixtures.local.etag = None
+    for _ in range(warmup):
+      send(rng, record=False)
+    thread_latencies = []
+    while next(counter) < total:
+      thread_latencies.append(send(rng))
+    with lock:
+      latencies.extend(thread_latencies)
+
+  def send(rng, record=True):
+    method, path, body, headers, expected = scenario(fixtures, rng)
+    started = time.perf_counter()
+    status, response_headers, _ = target.request(method, path, body, headers)
+    elapsed = time.perf_counter() - started
+    if response_headers.get('ETag'):
+      fixtures.local.etag = response_headers['ETag']
+    if record and status not in expected:
+      with lock:
+        errors.append(status)
+    return elapsed
+
+  before = sql_totals(target)
+  threads = [threading.Thread(target=worker, args=(worker_id,)) for worker_id in range(concurrency)]
+  started = time.perf_counter()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  wall = time.perf_counter() - started
+  after = sql_totals(target)
+
+  ordered = sorted(latencies)
+  return {
+    'requests': len(ordered),
+    'errors': len(errors),
+    'concurrency': concurrency,
+    'throughput_rps': round(len(ordered) / wall, 1),
+    'latency_ms': {
+      'p50': round(percentile(ordered, 50) * 1000, 3),
+      'p95': round(percentile(ordered, 95) * 1000, 3),
+      'p99': round(percentile(ordered, 99) * 1000, 3),
+      'mean': round(sum(ordered) / len(ordered) * 1000, 3),
+      'max': round(ordered[-1] * 1000, 3),
+    },
+    'sql_statements_per_request': sql_per_request(before, after),
+  }
+
+def git_revision():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+  except OSError:
+    return None
+
+def run(args):
+  target = HTTPTarget(args.url) if args.url else ClientTarget(args.db)
+  fixtures = Fixtures(args.db, target)
+  names = args.scenario or list(scenarios)
+
+  result = {
+    'meta': {
+      'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+      'revision': git_revision(),
+      'target': target.name,
+      'python': platform.python_version(),
+      'sqlite': sqlite3.sqlite_version,
+      'accounts': len(fixtures.accounts),
+      'rmas': len(fixtures.rma_ids),
+      'seed': args.seed,
+    },
+    'scenarios': {},
+  }
+  for name in names:
+    total = args.requests or scenario_requests[name]
+    stats = result['scenarios'][name] = run_scenario(target, fixtures, name, total, args.concurrency, args.warmup, args.seed)
+    latency = stats['latency_ms']
+    print(
+      f"{name:<12} {stats['throughput_rps']:>9.1f} req/s  p50 {latency['p50']:>8.2f} ms  p95 {latency['p95']:>8.2f} ms  "
+      f"p99 {latency['p99']:>8.2f} ms  sql/req {stats['sql_statements_per_request']}  errors {stats['errors']}",
+      file=sys.stderr,
+    )
+
+  output = json.dumps(result, indent=2) + '\n'
+  if args.out:
+    with open(args.out, 'w') as f:
+      f.write(output)
+  else:
+    sys.stdout.write(output)
+
+
+#***** Compare *****
+
+def compare(args):
+  with open(args.baseline) as f:
+    baseline = json.load(f)
+  with open(args.current) as f:
+    current = json.load(f)
+
+  regressions = []
+  for name, before in baseline['scenarios'].items():
+    after = current['scenarios'].get(name)
+    if after is None:
+      continue
+    checks = [
+      ('throughput_rps', before['throughput_rps'], after['throughput_rps'], -1),
+      ('p50_ms', before['latency_ms']['p50'], after['latency_ms']['p50'], 1),
+      ('p95_ms', before['latency_ms']['p95'], after['latency_ms']['p95'], 1),
+      ('p99_ms', before['latency_ms']['p99'], after['latency_ms']['p99'], 1),
+      ('sql/req', before['sql_statements_per_request'], after['sql_statements_per_request'], 1),
+      ('errors', before['errors'], after['errors'], 1),
+    ]
+    for metric, old, new, direction in checks:
+      if old is None or new is None:
+        continue
+      change = (new - old) / old if old else (0.0 if new == old else float('inf'))
+      if metric == 'errors':
+        regressed = new > old
+      elif metric == 'sql/req':
+        regressed = change > 0.05
+      elif metric.endswith('_ms'):
+        regressed = change > args.tolerance and new - old > args.min_delta_ms
+      else:
+        regressed = change * direction > args.tolerance
+      flag = 'REGRESSION' if regressed else ''
+      print(f'{name:<12} {metric:<15} {old:>10} -> {new:<10} {change:>+8.1%}  {flag}')
+      if regressed:
+        regressions.append((name, metric))
+
+  if regressions:
+    print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}: {', '.join(f'{n}.{m}' for n, m in regressions)}", file=sys.stderr)
+    sys.exit(1)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='RMA API benchmark harness')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  generate_parser = commands.add_parser('generate', help='fill a scratch SQLite database with synthetic accounts and RMAs')
+  generate_parser.add_argument('--db', required=True)
+  generate_parser.add_argument('--accounts', type=int, default=20)
+  generate_parser.add_argument('--rmas', type=int, default=5000)
+  generate_parser.add_argument('--batch-size', type=int, default=1000)
+  generate_parser.add_argument('--seed', type=int, default=1)
+  generate_parser.add_argument('--force', action='store_true')
+  generate_parser.set_defaults(handler=generate)
+
+  run_parser = commands.add_parser('run', help='run scenarios and write a JSON baseline')
+  run_parser.add_argument('--db', required=True)
+  run_parser.add_argument('--url', help='benchmark a live server instead of the Flask test client')
+  run_parser.add_argument('--scenario', action='append', choices=list(scenarios))
+  run_parser.add_argument('--requests', type=int, help='requests per scenario (default depends on the scenario)')
+  run_parser.add_argument('--concurrency', type=int, default=4)
+  run_parser.add_argument('--warmup', type=int, default=5)
+  run_parser.add_argument('--seed', type=int, default=1)
+  run_parser.add_argument('--out')
+  run_parser.set_defaults(handler=run)
+
+  compare_parser = commands.add_parser('compare', help='compare two JSON results and exit 1 on regression')
+  compare_parser.add_argument('baseline')
+  compare_parser.add_argument('current')
+  compare_parser.add_argument('--tolerance', type=float, default=0.10)
+  compare_parser.add_argument('--min-delta-ms', type=float, default=1.0, help='ignore latency changes smaller than this')
+  compare_parser.set_defaults(handler=compare)
+
+  args = parser.parse_args()
+  args.handler(args)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+
+import jwt
+import pytest
+
+from app import AccountInfo, RMA, create_app, db, status_blocks
+
+
+def build_app(path, rma_count):
+  app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}'})
+  with app.app_context():
+    technician = AccountInfo('tech', 'tech@example.com', 'unused', 0)
+    db.session.add(technician)
+    db.session.flush()
+    for index in range(rma_count):
+      rma = RMA(index + 1, f'FD{index:05}', index % 8, technician.id, 'diagnosis', '', '', False)
+      db.session.add(rma)
+      for _, status_model, default_data in status_blocks:
+        db.session.add(status_model(rma=rma, **default_data))
+    db.session.commit()
+    technician_id = technician.id
+    token = jwt.encode({'user_id': technician_id, 'exp': datetime.utcnow() + timedelta(hours=1)}, app.config['SECRET_KEY'], algorithm='HS256')
+  return app, technician_id, {'Authorization': f'Bearer {token}'}
+
+
+@pytest.fixture(scope='session')
+def make_app(tmp_path_factory):
+  def make(rma_count):
+    return build_app(tmp_path_factory.mktemp('app') / 'app.sqlite', rma_count)
+  return make
@@ -0,0 +1,42 @@
+import pytest
+from sqlalchemy import event
+
+from app import db, response_cache
+
+list_paths = ('/manager/rmas', '/rmas', '/account/{technician_id}/rmas')
+
+
+def count_statements(app, technician_id, headers, path):
+  client = app.test_client()
+  statements = []
+  with app.app_context():
+    engine = db.engine
+    response_cache.clear()
+
+  def record(conn, cursor, statement, parameters, context, executemany):
+    statements.append(statement)
+
+  # The first request also loads the account behind the token; count the second.
+  client.get(path.format(technician_id=technician_id), headers=headers)
+  with app.app_context():
+    response_cache.clear()
+  event.listen(engine, 'before_cursor_execute', record)
+  try:
+    response = client.get(path.format(technician_id=technician_id), headers=headers)
+  finally:
+    event.remove(engine, 'before_cursor_execute', record)
+  assert response.status_code == 200, response.get_data(as_text=True)
+  return len(statements), len(response.get_json()['data'])
+
+
+@pytest.fixture(scope='module')
+def apps(make_app):
+  return make_app(2), make_app(40)
+
+
+@pytest.mark.parametrize('path', list_paths)
+def test_list_statements_do_not_grow_with_rmas(apps, path):
+  (small, small_rmas), (large, large_rmas) = [count_statements(*app, path) for app in apps]
+  assert (small_rmas, large_rmas) == (2, 40)
+  assert large == small
+  assert large <= 2
@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+@pytest.fixture
+def client(make_app):
+  app, _, headers = make_app(1)
+  client = app.test_client()
+  client.environ_base['HTTP_AUTHORIZATION'] = headers['Authorization']
+  return client
+
+
+def test_out_of_range_readings_save_and_record_as_missing(client):
+  response = client.put('/rma/1/update_vac_status', json={'data': {'mtorr_bo': 3000000000}})
+  assert response.status_code == 200, response.get_json()
+  assert response.get_json()['data']['mtorr_bo'] == 3000000000
+
+  response = client.patch('/rma/1', json={'vac_status': {'mtorr_bo': -3000000000, 'mtorr_200': 7}})
+  assert response.status_code == 200, response.get_json()
+
+  history = client.get('/rma/1/history/vac_status?fields=mtorr_bo,mtorr_200').get_json()
+  assert history['samples'] == 2
+  assert [point['mtorr_bo'] for point in history['data']] == [None, None]
+  assert history['data'][-1]['mtorr_200'] == 7
+
+
+@pytest.mark.parametrize('timestamp', ('2020-01-01T00:00:00Z', '2020-01-01T02:00:00+02:00'))
+def test_timestamps_with_offsets_are_read_as_utc(client, timestamp):
+  assert client.put('/rma/1/update_vac_status', json={'data': {'mtorr_bo': 5}}).status_code == 200
+
+  response = client.get('/rma/1/history/vac_status', query_string={'from': timestamp})
+  assert response.status_code == 200, response.get_json()
+  assert response.get_json()['samples'] == 1
+
+  response = client.get('/manager/analytics', query_string={'table': 'vac_status', 'metric': 'mtorr_bo', 'from': timestamp})
+  assert response.status_code == 200, response.get_json()
+
+
+def test_analytics_converts_offsets_before_filtering(client):
+  # An hour from now, written in UTC-5: dropping the offset instead of converting it would
+  # move the bound five hours into the past and match every RMA.
+  bound = (datetime.now(timezone.utc) + timedelta(hours=1)).astimezone(timezone(timedelta(hours=-5)))
+  response = client.get('/manager/analytics', query_string={'table': 'vac_status', 'metric': 'mtorr_bo', 'from': bound.isoformat()})
+  assert response.status_code == 200, response.get_json()
+  assert response.get_json()['data'] == []
@@ -0,0 +1,78 @@
+import os
+import shutil
+import sqlite3
+from collections import Counter
+from datetime import datetime, timedelta
+
+import jwt
+
+from app import AccountInfo, RMA, create_app, db, purge_rmas, sync_models
+
+repo_database = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.sqlite')
+
+
+def sync_all(client, headers, since=0, limit=3):
+  received = Counter()
+  while True:
+    response = client.get('/sync', query_string={'since': since, 'limit': limit}, headers=headers)
+    assert response.status_code == 200, response.get_json()
+    data = response.get_json()
+    for table, rows in data['changed'].items():
+      received.update(('changed', table, row['id']) for row in rows)
+    for table, row_ids in data['deleted'].items():
+      received.update(('deleted', table, row_id) for row_id in row_ids)
+    assert data['version'] >= since
+    since = data['version']
+    if not data['has_more']:
+      return received, since
+
+
+def current_rows(app):
+  with app.app_context():
+    return Counter(
+      ('changed', table, row_id)
+      for table, model in sync_models.items()
+      for row_id in db.session.scalars(db.select(model.id))
+    )
+
+
+def purge_rma(app, rma_id):
+  before = current_rows(app)
+  with app.app_context():
+    assert purge_rmas([RMA.id == rma_id]) == 1
+  return Counter(('deleted', table, row_id) for _, table, row_id in before - current_rows(app))
+
+
+def test_small_pages_deliver_every_change_once(make_app):
+  app, _, headers = make_app(4)
+  client = app.test_client()
+  assert client.patch('/rma/1', json={'repair_notes': 'checked', 'vac_status': {'mtorr_bo': 3}}, headers=headers).status_code == 200
+  deleted = purge_rma(app, 2)
+  assert len(deleted) == len(sync_models)
+
+  received, version = sync_all(client, headers)
+  assert received == current_rows(app) + deleted
+
+  assert sync_all(client, headers, since=version) == (Counter(), version)
+  assert client.patch('/rma/3', json={'freeze_status': {'amp_reading': 4}}, headers=headers).status_code == 200
+  deleted = purge_rma(app, 4)
+  received, _ = sync_all(client, headers, since=version, limit=2)
+  with app.app_context():
+    freeze_id = db.session.scalar(db.select(sync_models['freeze_status'].id).where(sync_models['freeze_status'].rma_id == 3))
+  assert received == Counter([('changed', 'freeze_status', freeze_id)]) + deleted
+
+
+def test_small_pages_deliver_every_migrated_row_once(tmp_path):
+  path = tmp_path / 'app.sqlite'
+  shutil.copy(repo_database, path)
+  with sqlite3.connect(path) as conn:
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 0
+  app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}'})
+  with app.app_context():
+    user_id = db.session.scalar(db.select(AccountInfo.id).limit(1))
+    token = jwt.encode({'user_id': user_id, 'exp': datetime.utcnow() + timedelta(hours=1)}, app.config['SECRET_KEY'], algorithm='HS256')
+
+  expected = current_rows(app)
+  assert sum(expected.values()) > 3
+  received, _ = sync_all(app.test_client(), {'Authorization': f'Bearer {token}'})
+  assert received == expected